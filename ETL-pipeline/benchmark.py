@@ -0,0 +1,102 @@
+"""
+ETL scaling benchmark: runs the races pipeline on synthetic data (see
+synthetic.SyntheticData) at several scales and reports the time of each
+step, and how it grows with the data.
+
+    python benchmark.py --scales 1 10 100 --root ./../data/benchmark
+
+Each scale runs in its own process from <root>/x<scale>/etl, as the
+loaders read ./../data/... relative to the working directory, and cache
+what they parse for the process.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import numpy as np
+
+from profiling import StepProfiler
+
+
+def run_scale(root, scale, seed=0):
+    """
+    Generate the data of the scale and profile the pipeline on it (to run
+    from <root>/etl)
+    """
+    from synthetic import SyntheticData
+
+    data = SyntheticData(root, scale=scale, seed=seed).generate()
+    os.makedirs(os.path.join(root, 'etl'), exist_ok=True)
+    os.chdir(os.path.join(root, 'etl'))
+
+    from db import get_database
+    from load_ext import Races, ResultsDf, RacesTracks
+    from pipeline import make_preprocessor
+
+    # the SQLite db stands in for MySQL
+    results = ResultsDf(backend='sqlite', database=data.database, use_cache=False)
+    preprocessor = make_preprocessor(results=results, tracks=RacesTracks())
+
+    profiler = StepProfiler(report_dir=os.path.join(root, 'reports'))
+    profiler.fit_transform(preprocessor, Races().load(get_database('sqlite', data.database)))
+    with open(os.path.join(root, 'report.json'), 'w') as f:
+        json.dump(dict(profiler.report_, scale=scale), f, indent=2)
+
+
+def growth(times, scales):
+    """
+    Exponent of the time growth with the scale (slope in log-log), 1 is
+    linear, > 1 superlinear
+    """
+    times = np.maximum(times, 1e-3)
+    return np.polyfit(np.log(scales), np.log(times), 1)[0]
+
+
+def summary(reports):
+    scales = [report['scale'] for report in reports]
+    header = f"{'step':<45} " + ' '.join(f"{f'x{scale} (s)':>10}" for scale in scales) + f" {'growth':>7}"
+    lines = [header, '-' * len(header)]
+    for i, step in enumerate(reports[0]['steps']):
+        times = [report['steps'][i]['wall_time'] for report in reports]
+        line = f"{step['name'][:45]:<45} " + ' '.join(f"{time:>10.2f}" for time in times)
+        if len(scales) > 1:
+            exponent = growth(times, scales)
+            # below 0.1s the times are mostly noise
+            superlinear = exponent > 1.2 and max(times) >= 0.1
+            line += f" {exponent:>7.2f}" + (' superlinear' if superlinear else '')
+        lines.append(line)
+    lines.append('-' * len(header))
+    lines.append(f"{'total':<45} " + ' '.join(f"{report['wall_time']:>10.2f}" for report in reports))
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ETL scaling benchmark on synthetic data")
+    parser.add_argument('--scales', type=float, nargs='+', default=[1, 10, 100])
+    parser.add_argument('--root', default="./../data/benchmark")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--scale', type=float, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.scale is not None:
+        # worker process of one scale
+        run_scale(args.root, args.scale, args.seed)
+        return
+
+    reports = []
+    for scale in args.scales:
+        root = os.path.abspath(os.path.join(args.root, f"x{scale:g}"))
+        print(f"scale x{scale:g}")
+        subprocess.run([sys.executable, os.path.abspath(__file__), '--scale', str(scale),
+                        '--root', root, '--seed', str(args.seed)], check=True)
+        with open(os.path.join(root, 'report.json')) as f:
+            reports.append(json.load(f))
+
+    print(summary(reports))
+    with open(os.path.join(args.root, 'benchmark.json'), 'w') as f:
+        json.dump(reports, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
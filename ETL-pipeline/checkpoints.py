@@ -0,0 +1,204 @@
+import functools
+import glob
+import hashlib
+import inspect
+import os
+import pickle
+import re
+import sys
+import pandas as pd
+
+
+class StepCheckpoints:
+    """
+    Run the steps of a pipeline of transformers, saving the output of each
+    step. A rerun loads the output of the last step still valid and resumes
+    from the next one.
+
+    The key of a step output chains the key of its input with the step
+    fingerprint: class code (with its base classes of the transformers
+    module), code shared by the steps (functions of the transformers module,
+    and the ETL modules it uses: loaders, geo...), parameters, and the
+    loaders it reads from (`sources` of the transformer: loader code and
+    file modification time). Changing a step then invalidates its output and
+    the output of all the following steps.
+
+    Parameters which are objects (ResultsDf, RacesTracks...) are keyed by
+    the code of their class, and by their checkpoint_key method if any.
+
+    The outputs are pickled, to get back the exact frames (index and object
+    columns included), after the fitted attributes of the step. A resume
+    restores the fitted attributes of all the steps it skips, each from its
+    own checkpoint.
+    """
+    cache_dir = "./../data/cache/steps"
+    # part of the keys, to bump when the layout of the checkpoints changes,
+    # or code the fingerprints can't see (outside of the ETL modules)
+    version = 3
+
+    def __init__(self, cache_dir=None, verbose=True):
+        self.cache_dir = cache_dir or self.cache_dir
+        self.verbose = verbose
+
+    def fit_transform(self, pipeline, X):
+        steps = pipeline.steps
+        keys = []
+        key = hash_values(self.version, frame_key(X))
+        for name, step in steps:
+            key = hash_values(key, step_fingerprint(step))
+            keys.append(key)
+
+        # first step without a valid checkpoint
+        start = 0
+        while start < len(steps) and \
+                os.path.exists(self.path(start, steps[start][0], keys[start])):
+            start += 1
+        if start:
+            X = self.restore(start - 1, steps, keys)
+
+        for i in range(start, len(steps)):
+            name, step = steps[i]
+            self.log(f"running step {i}: {name}")
+            X = step.fit_transform(X)
+            self.save(i, steps[i], keys[i], X)
+        return X
+
+    def path(self, i, name, key):
+        return os.path.join(self.cache_dir, f"{i:02d}-{slugify(name)}-{key[:16]}.pkl")
+
+    def restore(self, i, steps, keys):
+        """
+        Output of step i, with the fitted attributes of steps 0-i
+        """
+        self.log(f"steps 0-{i} loaded from checkpoint ({steps[i][0]})")
+        for j in range(i + 1):
+            name, transformer = steps[j]
+            with open(self.path(j, name, keys[j]), 'rb') as f:
+                # the outputs of the steps before i are not read
+                fitted = pickle.load(f)
+                if j == i:
+                    X = pickle.load(f)
+            for attr, value in fitted.items():
+                setattr(transformer, attr, value)
+        return X
+
+    def save(self, i, step, key, X):
+        name, transformer = step
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # outdated checkpoints of the step
+        for path in glob.glob(os.path.join(self.cache_dir, f"{i:02d}-{slugify(name)}-*.pkl")):
+            os.remove(path)
+        with open(self.path(i, name, key), 'wb') as f:
+            pickle.dump(fitted_attributes(transformer), f)
+            pickle.dump(X, f)
+
+    def log(self, message):
+        if self.verbose:
+            print(message)
+
+
+def slugify(name):
+    return re.sub(r'[^a-z0-9]+', '_', name.lower()).strip('_')
+
+
+def hash_values(*values):
+    return hashlib.sha1(repr(values).encode()).hexdigest()
+
+
+def frame_key(X):
+    """
+    Content hash of a dataframe (values, index, columns and dtypes)
+    """
+    hashes = pd.util.hash_pandas_object(X, index=True).values
+    return hash_values(hashlib.sha1(hashes.tobytes()).hexdigest(),
+                       list(X.columns), [str(dtype) for dtype in X.dtypes])
+
+
+def code_key(cls):
+    try:
+        return hashlib.sha1(inspect.getsource(cls).encode()).hexdigest()
+    except (OSError, TypeError):
+        return cls.__qualname__
+
+
+def param_key(value, data=True):
+    if value is None or isinstance(value, (str, int, float, bool, list, tuple, dict)):
+        return repr(value)
+    key = (type(value).__qualname__, code_key(type(value)))
+    if data and hasattr(value, 'checkpoint_key'):
+        key += (value.checkpoint_key(),)
+    return key
+
+
+def local_modules(module, found=None):
+    """
+    Names of the ETL modules (same directory) used by the module,
+    recursively. config holds the settings of the run, not code.
+    """
+    found = set() if found is None else found
+    if not getattr(module, '__file__', None):
+        # interactive session
+        return found
+    directory = os.path.dirname(os.path.abspath(module.__file__))
+    for value in vars(module).values():
+        used = value if inspect.ismodule(value) else inspect.getmodule(value)
+        path = getattr(used, '__file__', None)
+        if used is None or used is module or used.__name__ in found or \
+                used.__name__ == 'config' or not path or \
+                os.path.dirname(os.path.abspath(path)) != directory:
+            continue
+        found.add(used.__name__)
+        local_modules(used, found)
+    return found
+
+
+@functools.lru_cache(maxsize=None)
+def shared_code_key(module_name):
+    """
+    Code shared by the steps of a module: its functions, and the source of
+    the ETL modules it uses. The classes of the module are keyed by step.
+    """
+    module = sys.modules[module_name]
+    functions = [code_key(value) for _, value in sorted(vars(module).items())
+                 if inspect.isfunction(value) and value.__module__ == module_name]
+    modules = []
+    for name in sorted(local_modules(module) - {module_name}):
+        with open(sys.modules[name].__file__, 'rb') as f:
+            modules.append((name, hashlib.sha1(f.read()).hexdigest()))
+    return hash_values(functions, modules)
+
+
+def source_key(source, files=True):
+    """
+    Code of a loader, and modification time of the file it reads if any
+    """
+    loader = source() if isinstance(source, type) else source
+    url = getattr(loader, 'url', '') if files else ''
+    files = [path for path in [url, f"{url}.parquet", f"{url}.pkl"]
+             if url and os.path.isfile(path)]
+    return (code_key(type(loader)),
+            [(path, os.stat(path).st_mtime_ns, os.stat(path).st_size) for path in files])
+
+
+def step_fingerprint(step, data=True):
+    """
+    Key of the code, parameters and sources of a step. With data=False,
+    leaves out what changes with the data of the races (results watermark,
+    files of the sources by race), see IncrementalETL.
+    """
+    code = [code_key(cls) for cls in type(step).__mro__
+            if cls.__module__ == type(step).__module__]
+    code.append(shared_code_key(type(step).__module__))
+    params = {name: param_key(value, data)
+              for name, value in sorted(step.get_params(deep=False).items())}
+    sources = [source_key(source, files=data or not getattr(source, 'by_race', False))
+               for source in getattr(step, 'sources', [])]
+    return hash_values(code, params, sources)
+
+
+def fitted_attributes(step):
+    """
+    Attributes set by fit/transform (sklearn convention: trailing _)
+    """
+    return {attr: value for attr, value in vars(step).items()
+            if attr.endswith('_') and not attr.startswith('_')}
@@ -0,0 +1,222 @@
+"""
+Access to the races db: MySQL, or a local SQLite/DuckDB snapshot of it
+(db_backend and db_path in config), through a pool of connections shared
+by the ETL (and the notebooks, see notebooks/utils/get_processed_data).
+"""
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+import pandas as pd
+
+from config import Cfg as cfg
+
+# SQL differences between the supported backends
+SQL_DIALECTS = {
+    'mysql': {
+        'placeholder': '%s',
+        'integer': 'SIGNED',
+        'days_between': 'DATEDIFF(MAX({col}), MIN({col}))',
+        'contains': "LOCATE(BINARY '{sub}', {col}) > 0"
+    },
+    'sqlite': {
+        'placeholder': '?',
+        'integer': 'INTEGER',
+        'days_between': 'julianday(MAX({col})) - julianday(MIN({col}))',
+        'contains': "instr({col}, '{sub}') > 0"
+    },
+    'duckdb': {
+        'placeholder': '?',
+        'integer': 'INTEGER',
+        'days_between': "date_diff('day', MIN(CAST({col} AS DATE)), MAX(CAST({col} AS DATE)))",
+        'contains': "strpos({col}, '{sub}') > 0"
+    }
+}
+
+# above, IN filters are left to pandas (SQLite limits the parameters of a
+# query to 999 in older versions)
+MAX_PARAMS = 900
+
+
+class Database:
+    """
+    Pool of connections to one db. Use get_database to share the pool
+    within a process.
+
+    select builds projected and parametrized queries, read_sql and
+    read_chunks run them on a pooled connection.
+    """
+
+    def __init__(self, backend='mysql', database=None, pool_size=4):
+        if backend not in SQL_DIALECTS:
+            raise ValueError(f"Unknown backend: {backend}")
+        self.backend = backend
+        # file of the SQLite/DuckDB db
+        self.database = database
+        self.pool_size = pool_size
+        self._pool = None
+        self._lock = threading.Lock()
+
+    @property
+    def dialect(self):
+        return SQL_DIALECTS[self.backend]
+
+    def connect(self):
+        """
+        New connection, outside of the pool
+        """
+        if self.backend == 'mysql':
+            import mysql.connector
+            return mysql.connector.connect(user=cfg.mysql_user, database=cfg.mysql_db,
+                                           password=cfg.mysql_pw, ssl_disabled=True)
+        elif self.backend == 'sqlite':
+            # pooled connections go from thread to thread
+            return sqlite3.connect(self.database, check_same_thread=False)
+        else:
+            import duckdb
+            return duckdb.connect(self.database)
+
+    @contextmanager
+    def connection(self):
+        """
+        Connection of the pool, given back once the block is done
+        """
+        with self._lock:
+            if self._pool is None:
+                if self.backend == 'mysql':
+                    from mysql.connector import pooling
+                    self._pool = pooling.MySQLConnectionPool(
+                        pool_size=self.pool_size, user=cfg.mysql_user,
+                        database=cfg.mysql_db, password=cfg.mysql_pw,
+                        ssl_disabled=True)
+                else:
+                    self._pool = queue.LifoQueue()
+
+        if self.backend == 'mysql':
+            from mysql.connector.errors import PoolError
+            try:
+                # close() gives the connection back to the mysql pool
+                cnx = self._pool.get_connection()
+            except PoolError:
+                # all in use, one more outside of the pool
+                cnx = self.connect()
+            try:
+                yield cnx
+            finally:
+                cnx.close()
+            return
+
+        try:
+            cnx = self._pool.get_nowait()
+        except queue.Empty:
+            cnx = self.connect()
+        reusable = False
+        try:
+            yield cnx
+            reusable = True
+        finally:
+            # connections of a failed block are not reused
+            if reusable and self._pool.qsize() < self.pool_size:
+                self._pool.put(cnx)
+            else:
+                cnx.close()
+
+    def select(self, table, columns=None, where=None, filters=None):
+        """
+        Query and params of SELECT <columns> FROM <table>, with
+        - where: list of conditions written in SQL, with their params:
+          [("year < {}", 2019)], the {} are replaced by the placeholder
+        - filters: {column: value or list of values}
+        """
+        placeholder = self.dialect['placeholder']
+        conditions, params = [], []
+        for condition, *values in where or []:
+            conditions.append(condition.format(*[placeholder] * len(values)))
+            params += values
+        for column, values in (filters or {}).items():
+            if isinstance(values, (list, tuple, set, pd.Index, pd.Series)):
+                values = list(values)
+                conditions.append(f"{column} IN ({', '.join([placeholder] * len(values))})")
+                params += values
+            else:
+                conditions.append(f"{column} = {placeholder}")
+                params.append(values)
+
+        query = f"SELECT {', '.join(columns) if columns else '*'} FROM {table}"
+        if conditions:
+            query += f" WHERE {' AND '.join(conditions)}"
+        return f"{query};", params
+
+    def read_sql(self, query, params=None):
+        """
+        Dataframe of the query
+        """
+        with self.connection() as cnx:
+            if self.backend == 'duckdb':
+                return cnx.execute(query, params or []).df()
+            return pd.read_sql(query, con=cnx, params=params or None)
+
+    def read_chunks(self, query, params=None, chunksize=100000):
+        """
+        Dataframes of chunksize rows of the query, streamed while the
+        connection is held
+        """
+        with self.connection() as cnx:
+            if self.backend == 'duckdb':
+                cursor = cnx.execute(query, params or [])
+                while True:
+                    chunk = cursor.fetch_df_chunk()
+                    if not len(chunk):
+                        break
+                    yield chunk
+            else:
+                yield from pd.read_sql(query, con=cnx, params=params or None,
+                                       chunksize=chunksize)
+
+    def fetchone(self, query, params=None):
+        with self.connection() as cnx:
+            cursor = cnx.cursor()
+            try:
+                cursor.execute(query, params or ())
+                return cursor.fetchone()
+            finally:
+                cursor.close()
+
+    def write(self, df, table):
+        """
+        Replace the table with the dataframe (SQLite/DuckDB snapshots)
+        """
+        with self.connection() as cnx:
+            if self.backend == 'duckdb':
+                cnx.register('df', df)
+                cnx.execute(f"CREATE OR REPLACE TABLE {table} AS SELECT * FROM df")
+                cnx.unregister('df')
+            else:
+                df.to_sql(table, cnx, if_exists='replace', index=False)
+                cnx.commit()
+
+    def close(self):
+        with self._lock:
+            if isinstance(self._pool, queue.Queue):
+                while not self._pool.empty():
+                    self._pool.get_nowait().close()
+            self._pool = None
+
+
+# pools of the process, by backend and db
+_databases = {}
+_databases_lock = threading.Lock()
+
+
+def get_database(backend=None, database=None):
+    """
+    Shared Database of the backend (db_backend in config, mysql by default)
+    """
+    backend = backend or getattr(cfg, 'db_backend', 'mysql')
+    if backend != 'mysql':
+        database = database or getattr(cfg, 'db_path', None)
+    with _databases_lock:
+        if (backend, database) not in _databases:
+            _databases[(backend, database)] = Database(
+                backend, database, pool_size=getattr(cfg, 'db_pool_size', 4))
+        return _databases[(backend, database)]
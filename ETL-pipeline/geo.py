@@ -0,0 +1,139 @@
+import hashlib
+import inspect
+import os
+import pickle
+import numpy as np
+from scipy.spatial import cKDTree
+
+# mean radius, in meters
+EARTH_RADIUS = 6371000
+
+# version of the persisted indexes, to bump when the way they are built
+# changes outside of this module
+INDEX_VERSION = 1
+
+
+def to_unit_vectors(lat, lon):
+    """
+    lat/lon (in degrees) as points on the unit sphere
+    """
+    lat_rad = np.radians(lat)
+    lon_rad = np.radians(lon)
+    return np.column_stack([
+        np.cos(lat_rad) * np.cos(lon_rad),
+        np.cos(lat_rad) * np.sin(lon_rad),
+        np.sin(lat_rad)
+    ])
+
+
+def chord_to_distance(chord):
+    """
+    Great-circle distance (in meters) from the chord length on the unit
+    sphere (2 * arcsin(chord / 2) is the angle, as in the haversine)
+    """
+    return 2 * EARTH_RADIUS * np.arcsin(np.minimum(chord / 2, 1))
+
+
+class GeoIndex:
+    """
+    Nearest neighbour index over a set of lat/lon points (shorelines,
+    airports...): the points are mapped on the unit sphere and stored in a
+    KD-tree, so all the races are queried in one call instead of computing
+    the distance to every point.
+
+    Use GeoIndex.load to build it once and persist it next to the file the
+    points come from.
+    """
+
+    def __init__(self, lat, lon):
+        lat = np.asarray(lat, dtype=float)
+        lon = np.asarray(lon, dtype=float)
+        valid = np.isfinite(lat) & np.isfinite(lon)
+        self.tree = cKDTree(to_unit_vectors(lat[valid], lon[valid]))
+
+    def __len__(self):
+        return self.tree.n
+
+    def _query_points(self, lat, lon):
+        lat = np.asarray(lat, dtype=float)
+        lon = np.asarray(lon, dtype=float)
+        # races without location get NaN
+        valid = np.isfinite(lat) & np.isfinite(lon)
+        return to_unit_vectors(lat[valid], lon[valid]), valid
+
+    def query(self, lat, lon, k=1):
+        """
+        Distances (in meters) to the k nearest points, shape (n,) for k=1
+        else (n, k)
+        """
+        points, valid = self._query_points(lat, lon)
+        distances = np.full((len(valid), k), np.nan)
+        if len(points) and len(self):
+            chords, _ = self.tree.query(points, k=k)
+            distances[valid] = chord_to_distance(chords).reshape(-1, k)
+        return distances[:, 0] if k == 1 else distances
+
+    @classmethod
+    def load(cls, source, name, get_points, depends_on=()):
+        """
+        Index of the points of the source file, persisted as
+        <source>.<name>.geoindex and rebuilt when the source file changes.
+
+        get_points returns a dataframe with the lat/lon of the points to
+        index, it is only called when the index needs to be (re)built.
+        depends_on lists what selects the points besides the source file
+        (filter functions, parameters...), the index is also rebuilt when
+        their code or values change.
+        """
+        def build():
+            points = get_points()
+            return cls(points['lat'], points['lon'])
+        return load_persisted(source, name, build, [cls, get_points, *depends_on])
+
+
+# indexes loaded in this process, by persisted file
+_loaded = {}
+
+
+def code_hash(obj):
+    """
+    Hash of the code of a function/class, of the value of anything else
+    """
+    if inspect.isfunction(obj) or inspect.ismethod(obj) or inspect.isclass(obj):
+        try:
+            code = inspect.getsource(obj)
+        except (OSError, TypeError):
+            code = obj.__qualname__
+    else:
+        code = repr(obj)
+    return hashlib.sha1(code.encode()).hexdigest()
+
+
+def load_persisted(source, name, build, depends_on=()):
+    """
+    Object built from the source file, pickled as <source>.<name>.geoindex
+    and rebuilt (build()) when the source file changes, or the code/values
+    it depends on
+    """
+    path = f"{source}.{name}.geoindex"
+    stat = os.stat(source)
+    key = (INDEX_VERSION, name, [code_hash(obj) for obj in depends_on],
+           stat.st_mtime_ns, stat.st_size)
+
+    if _loaded.get(path, (None, None))[0] == key:
+        return _loaded[path][1]
+
+    loaded = None
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            saved_key, saved = pickle.load(f)
+        if saved_key == key:
+            loaded = saved
+
+    if loaded is None:
+        loaded = build()
+        with open(path, 'wb') as f:
+            pickle.dump((key, loaded), f)
+
+    _loaded[path] = (key, loaded)
+    return loaded
@@ -0,0 +1,171 @@
+import hashlib
+import json
+import os
+import pandas as pd
+
+from checkpoints import hash_values, step_fingerprint
+
+
+class IncrementalETL:
+    """
+    Run the pipeline only for the races whose inputs changed since the
+    previous run, and merge them into the previous races features.
+
+    Each race gets a fingerprint of its inputs: its row once the cleanup
+    steps have run (up to the step fingerprints_after, run on all the
+    races), its entries in the sources by race of the steps (descriptions,
+    entrants counts, weather, POIs...), and its results in the db. The
+    other steps only run for the races whose fingerprint changed.
+
+    Steps with per_race = False compute features over all the races
+    (RaceAttractivity priors...). They run on all the races, and their
+    columns are updated for the unchanged races too; they are skipped if
+    their inputs (code, sources, results watermark, races) didn't change.
+
+    A change in the code or parameters of a step, or in a source which is
+    not by race, triggers a full run.
+
+    The state (fingerprints) is saved next to the features file by
+    save_state, to call once the features are written.
+    """
+
+    def __init__(self, pipeline, features_file, fingerprints_after, verbose=True):
+        self.pipeline = pipeline
+        self.features_file = features_file
+        self.fingerprints_after = fingerprints_after
+        self.verbose = verbose
+        self.state = None
+
+    @property
+    def state_file(self):
+        return f"{os.path.splitext(self.features_file)[0]}.fingerprints.json"
+
+    def load_previous(self):
+        if not (os.path.exists(self.state_file) and os.path.exists(self.features_file)):
+            return None, None
+        with open(self.state_file) as f:
+            state = json.load(f)
+        features = pd.read_csv(self.features_file, float_precision='round_trip')
+        return state, features
+
+    def split_steps(self):
+        names = [name for name, _ in self.pipeline.steps]
+        last_cleanup = names.index(self.fingerprints_after) + 1
+        return self.pipeline.steps[:last_cleanup], self.pipeline.steps[last_cleanup:]
+
+    def fit_transform(self, X):
+        cleanup, steps = self.split_steps()
+        for name, step in cleanup:
+            X = step.fit_transform(X)
+        X = X.drop_duplicates('race')
+        races = X['race']
+
+        pipeline_key = hash_values([step_fingerprint(step, data=False) for _, step in steps])
+        fingerprints = self.fingerprints(X, steps)
+
+        state, previous = self.load_previous()
+        if state is None or state['pipeline'] != pipeline_key:
+            self.log("full run")
+            state, previous = {'races': {}, 'global': {}}, None
+
+        changed = [race for race in races
+                   if state['races'].get(race) != fingerprints[race]]
+        self.log(f"{len(changed)} of {len(races)} races to compute")
+
+        X_changed = X.loc[X['race'].isin(changed)]
+        unchanged = (previous.loc[previous['race'].isin(races) & ~previous['race'].isin(changed)]
+                     if previous is not None else None)
+
+        global_keys = {}
+        for name, step in steps:
+            if getattr(step, 'per_race', True):
+                if len(X_changed):
+                    X_changed = step.fit_transform(X_changed)
+                continue
+
+            # global step, on all the races
+            global_key = hash_values(step_fingerprint(step), sorted(races))
+            global_keys[name] = {'key': global_key}
+            previous_global = state['global'].get(name, {})
+            columns = previous_global.get('columns')
+            if previous is not None and previous_global.get('key') == global_key and \
+               all(col in previous.columns for col in columns):
+                self.log(f"{name}: unchanged")
+                features = previous[['race'] + columns]
+            else:
+                self.log(f"{name}: running on all the races")
+                features = step.fit_transform(X)
+                columns = [col for col in features.columns if col not in X.columns]
+                features = features[['race'] + columns]
+            global_keys[name]['columns'] = columns
+
+            if len(X_changed):
+                X_changed = X_changed.drop(columns, axis=1, errors='ignore').merge(
+                    features, left_on="race", right_on="race", how="left")
+            if unchanged is not None:
+                unchanged = unchanged.drop(columns, axis=1, errors='ignore').merge(
+                    features, left_on="race", right_on="race", how="left")
+
+        parts = [part for part in [unchanged, X_changed if len(X_changed) else None]
+                 if part is not None]
+        columns = (X_changed if len(X_changed) else previous).columns
+        merged = pd.concat([part[columns] for part in parts], ignore_index=True)
+
+        # back to the order of the races
+        merged = merged.set_index('race').loc[races].reset_index()[columns]
+
+        self.state = {
+            'pipeline': pipeline_key,
+            'races': fingerprints,
+            'global': global_keys
+        }
+        return merged
+
+    def fingerprints(self, X, steps):
+        """
+        {race: fingerprint of its inputs}
+        """
+        races = list(X['race'])
+        entries = {race: [] for race in races}
+
+        # row of the race
+        for race, row in zip(races, X.to_dict(orient='records')):
+            entries[race].append(json.dumps(row, sort_keys=True, default=str))
+
+        # entries of the race in the sources by race
+        loaded = set()
+        for _, step in steps:
+            for source in getattr(step, 'sources', []):
+                loader = source() if isinstance(source, type) else source
+                if not getattr(loader, 'by_race', False) or repr(loader) in loaded:
+                    continue
+                loaded.add(repr(loader))
+                data = loader.load()
+                if isinstance(data, pd.DataFrame):
+                    # table with a race column
+                    data = {race: rows.drop(columns='race').to_dict(orient='records')
+                            for race, rows in data.groupby('race', sort=False)}
+                for race in races:
+                    entries[race].append(json.dumps(
+                        [data.get(race), data.get(race.lower())],
+                        sort_keys=True, default=str))
+
+        # results of the race
+        results = {id(value): value for _, step in steps
+                   for value in step.get_params(deep=False).values()
+                   if hasattr(value, 'race_watermarks')}
+        for result in results.values():
+            watermarks = result.race_watermarks(races)
+            for race in races:
+                entries[race].append(watermarks.get(race, ''))
+
+        return {race: hashlib.sha1('\n'.join(entries[race]).encode()).hexdigest()
+                for race in races}
+
+    def save_state(self):
+        with open(self.state_file, 'w') as f:
+            json.dump(self.state, f)
+
+    def log(self, message):
+        if self.verbose:
+            print(message)
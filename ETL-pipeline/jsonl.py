@@ -0,0 +1,28 @@
+import json
+
+try:
+    # faster decoder, if installed
+    import orjson
+    loads, DecodeError = orjson.loads, orjson.JSONDecodeError
+except ImportError:
+    loads, DecodeError = json.loads, json.JSONDecodeError
+
+
+def iter_jsonl(path, keys=None):
+    """
+    Items of a JSON-lines file, decoded one line at a time. With keys, only
+    these keys are kept (the ones present in the item).
+    """
+    with open(path, 'rb') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                item = loads(line)
+            except DecodeError:
+                # NaN/Infinity are not standard JSON, only json reads them
+                item = json.loads(line)
+            if keys is not None and isinstance(item, dict):
+                item = {key: item[key] for key in keys if key in item}
+            yield item
@@ -1,56 +1,132 @@
+import glob
+import hashlib
 import json
+import os
+import pickle
+import threading
 import numpy as np
 import pandas as pd
-import mysql.connector
+from pandas.api.types import union_categoricals
 from dataclasses import dataclass
 from config import Cfg as cfg
 
+from db import get_database, MAX_PARAMS
+from jsonl import iter_jsonl
+
+
+# parsed files of the loaders in this process, by (path, loader)
+_loaded = {}
+_loaded_lock = threading.Lock()
+_loading_locks = {}
+
+
+def cached_load(path, parse, name=''):
+    """
+    parse(path), memoized until the file changes (modification time and
+    size). With loaders_disk_cache = True in config, the parsed data is
+    also pickled in ./../data/cache/loaders, for the next runs.
+
+    The parsed data is shared by all the callers: dataframes are copied,
+    other data must not be modified.
+    """
+    stat = os.stat(path)
+    key = (stat.st_mtime_ns, stat.st_size)
+    with _loaded_lock:
+        lock = _loading_locks.setdefault((path, name), threading.Lock())
+
+    # each file parsed once even if loaded from several threads
+    with lock:
+        if _loaded.get((path, name), (None, None))[0] != key:
+            _loaded[(path, name)] = (key, load_parsed(path, parse, name, key))
+        data = _loaded[(path, name)][1]
+    return data.copy() if isinstance(data, pd.DataFrame) else data
+
+
+def load_parsed(path, parse, name, key):
+    if not getattr(cfg, 'loaders_disk_cache', False):
+        return parse(path)
+
+    cache_file = os.path.join(
+        "./../data/cache/loaders",
+        f"{hashlib.sha1(f'{os.path.abspath(path)}-{name}'.encode()).hexdigest()[:16]}.pkl")
+    if os.path.exists(cache_file):
+        with open(cache_file, 'rb') as f:
+            saved_key, data = pickle.load(f)
+        if saved_key == key:
+            return data
+
+    data = parse(path)
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    with open(cache_file, 'wb') as f:
+        pickle.dump((key, data), f, protocol=pickle.HIGHEST_PROTOCOL)
+    return data
+
 
 @dataclass
-class BaseLoadJSON:
+class BaseLoadFile:
+    """
+    Loader of a file, parsed (parse) once until it changes, see cached_load
+    """
     url = ''
 
     def load(self):
-        with open(self.url, 'r') as f:
+        return cached_load(self.url, self.parse, type(self).__name__)
+
+    def parse(self, path):
+        raise NotImplementedError
+
+
+@dataclass
+class BaseLoadJSON(BaseLoadFile):
+
+    @staticmethod
+    def parse(path):
+        with open(path, 'r') as f:
             data = json.loads(f.read())
         return data
 
 
 @dataclass
-class BaseLoadCSV:
-    url = ''
+class BaseLoadCSV(BaseLoadFile):
     columns = []
 
-    def load(self):
+    def parse(self, path):
         if not self.columns:
-            return pd.read_csv(self.url)
+            return pd.read_csv(path)
         else:
-            return pd.read_csv(self.url, names=self.columns)
+            return pd.read_csv(path, names=self.columns)
 
 
 @dataclass
 class RacesGeoInfo(BaseLoadJSON):
+    # dict by race (see IncrementalETL)
+    by_race = True
     url = "./../data/geo-data/races_geo_info.json"
 
 
 @dataclass
-class RacesDescription:
+class RacesDescription(BaseLoadFile):
+    # dict by race (see IncrementalETL)
+    by_race = True
     url = "./../data/races/races-description.jl"
 
-    def load(self):
+    # keys used by the transformers
+    keys = ['id', 'name', 'date', 'location']
+
+    def parse(self, path):
         descriptions = {}
-        with open(self.url) as f:
-            for line in f.readlines():
-                data = json.loads(line.strip())
-                if (data.get('id', "TBD") != "TBD"):
-                    descriptions[data['id']] = data
-                else:
-                    descriptions[f"TBD_{data['name']}"] = data
+        for data in iter_jsonl(path, self.keys):
+            if (data.get('id', "TBD") != "TBD"):
+                descriptions[data['id']] = data
+            else:
+                descriptions[f"TBD_{data['name']}"] = data
         return descriptions
 
 
 @dataclass
 class MissingRegions:
+    # dict by race (see IncrementalETL)
+    by_race = True
     missing_regions = {
         'challengeroth': 'Europe',
         'edinburgh70.3': 'Europe',
@@ -69,38 +145,32 @@ class MissingRegions:
 
 
 @dataclass
-class RacesEntrantsCount:
+class RacesEntrantsCount(BaseLoadFile):
+    # dict by race (see IncrementalETL)
+    by_race = True
     url = "./../data/races/races-athletes-count.jl"
 
-    def load(self):
+    @staticmethod
+    def parse(path):
         races_entrants_count = {}
-        with open(self.url) as f:
-            for line in f.readlines():
-                data = json.loads(line.strip())
-                if races_entrants_count.get(data['id']):
-                    races_entrants_count[data['id']].append({
-                        "year": int(data['date'][:4]),
-                        "entrants": data['count']
-                    })
-                else:
-                    races_entrants_count[data['id']] = [{
-                        "year": int(data['date'][:4]),
-                        "entrants": data['count']
-                    }]
+        for data in iter_jsonl(path, ['id', 'date', 'count']):
+            races_entrants_count.setdefault(data['id'], []).append({
+                "year": int(data['date'][:4]),
+                "entrants": data['count']
+            })
         return races_entrants_count
 
 
 @dataclass
-class IronKidsRaces:
+class IronKidsRaces(BaseLoadFile):
     url = "./../data/races/ironKids-races.json"
 
-    def load(self):
-        ironKids_races = {}
-        with open(self.url) as f:
-            for line in f.readlines():
-                data = json.loads(line.strip())
-                ironKids_races[data['name'].strip().replace("IRONKIDS ", "")] = data
-        return ironKids_races
+    @staticmethod
+    def parse(path):
+        return {
+            data['name'].strip().replace("IRONKIDS ", ""): data
+            for data in iter_jsonl(path, ['name', 'url'])
+        }
 
 
 @dataclass
@@ -132,35 +202,102 @@ class IronKidsRacesManualMatched:
 
 
 @dataclass
-class AllRaces:
+class AllRaces(BaseLoadFile):
     url = "./../data/races/races.jl"
 
-    def load(self):
-        all_races = {}
-        with open(self.url) as f:
-            for line in f.readlines():
-                data = json.loads(line.strip())
-                all_races[data['website'].split('.asp')[0]] = data
-        return all_races
+    @staticmethod
+    def parse(path):
+        return {
+            data['website'].split('.asp')[0]: data
+            for data in iter_jsonl(path, ['id', 'name', 'website'])
+        }
+
+
+@dataclass
+class Races:
+    """
+    Races table, the columns used by the pipeline
+    """
+    columns = ['race', 'racename', 'date', 'imlink', 'city', 'image_url',
+               'logo_url', 'region', 'images', 'map', 'info', 'ironkids_race']
+
+    def load(self, db=None):
+        db = db or get_database()
+        races = db.read_sql(*db.select('races', self.columns))
+        # dates as read from MySQL (text in SQLite snapshots)
+        races['date'] = pd.to_datetime(races['date']).dt.date
+        return races
 
 
 @dataclass
 class ResultsDf:
-    def __init__(self, current_races=[]):
+    """
+    Results table, cleaned for the current races.
+
+    One instance can be shared by all the transformers of a pipeline run:
+    the table is only read once, and the cleaned table is cached on disk
+    as long as the db content doesn't change.
+
+    With mode='sql', the transformers don't load the table but send their
+    aggregation queries to the db (MySQL, or a local SQLite/DuckDB mirror
+    of the results table, see mirror).
+
+    The db is the one of the config (db_backend/db_path) unless backend
+    and database are given, see db.get_database.
+    """
+    cache_dir = "./../data/cache"
+    year_threshold = 2019
+    # columns used by the transformers
+    columns = ['race', 'athlete', 'country', 'division', 'year', 'date',
+               'swim', 'bike', 'run']
+    # rows fetched from the db at once
+    chunksize = 100000
+
+    def __init__(self, current_races=[], use_cache=True, mode='pandas',
+                 backend=None, database=None):
         self.data = None
         self.current_races = current_races
+        self.use_cache = use_cache
+        self.mode = mode
+        self.backend = backend or getattr(cfg, 'db_backend', 'mysql')
+        # file of the SQLite/DuckDB db
+        self.database = database or (getattr(cfg, 'db_path', None)
+                                     if self.backend != 'mysql' else None)
+        self._races_key = None
+        # transformers can share it from several threads (StageRunner)
+        self._lock = threading.RLock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
 
-    def cleanUpData(self, yearThreshold=2019):
-        # worldchampionship70.3 and worldchampionship70.3m are the same race
-        self.data.loc[self.data.race == "worldchampionship70.3m", 'race'] = 'worldchampionship70.3'
-        # keep only results of non discontinued races
-        self.data = self.data.loc[self.data['race'].isin(self.current_races)]
-        # convert date to datetime
-        self.data['date'] = pd.to_datetime(self.data['date'])
-        self.data['year'] = self.data['year'].apply(int)
+    @property
+    def db(self):
+        # pool of the process, not pickled with the instance
+        return get_database(self.backend, self.database)
 
-        # keep only results from before yearThreshold since year is running currently
-        self.data = self.data.loc[self.data['year'] < yearThreshold]
+    @property
+    def dialect(self):
+        return self.db.dialect
+
+    def cleanUpData(self, data, yearThreshold=None):
+        """
+        Clean up a chunk of the results table
+        """
+        yearThreshold = yearThreshold or self.year_threshold
+        # worldchampionship70.3 and worldchampionship70.3m are the same race
+        data.loc[data.race == "worldchampionship70.3m", 'race'] = 'worldchampionship70.3'
+        data['year'] = pd.to_numeric(data['year']).astype(np.int16)
+        # keep only results of non discontinued races, and from before
+        # yearThreshold since year is running currently
+        data = data.loc[data['race'].isin(self.current_races) &
+                        (data['year'] < yearThreshold)]
+        return type_results(data)
 
     def addFeatures(self):
         # add years in sport
@@ -173,22 +310,308 @@ class ResultsDf:
         self.data = self.data.merge(years_in_sport, left_on="athlete", right_on="athlete", how="left")
         self.data['years_in_sport'] = self.data.years_in_sport.astype(int)
 
-    def load(self):
-        if self.data is None:
-            cnx = mysql.connector.connect(user=cfg.mysql_user, database=cfg.mysql_db,
-                                          password=cfg.mysql_pw, ssl_disabled=True)
-
-            query = "SELECT * FROM results;"
-
-            # execute the query and assign it to a pandas dataframe
-            self.data = pd.read_sql(query, con=cnx)
+    def watermark(self):
+        """
+        Changes whenever results are added to the db
+        """
+        values = self.db.fetchone("SELECT COUNT(*), MAX(date), MAX(year) FROM results;")
+        return '-'.join(str(value) for value in values)
+
+    def checkpoint_key(self):
+        """
+        Identifies the results the transformers get (see StepCheckpoints)
+        """
+        return f"{self.backend}:{self.database}:{self.mode}:{self.year_threshold}:{self.watermark()}"
+
+    def race_watermarks(self, races):
+        """
+        Per race version of watermark, {race: watermark}
+        """
+        watermarks = self.query("""
+            SELECT race, COUNT(*) AS n_results, MAX(date) AS last_date, MAX(year) AS last_year
+            FROM clean
+            GROUP BY race
+        """, current_races=races)
+        return {
+            race: f"{n_results}-{last_date}-{last_year}"
+            for race, n_results, last_date, last_year in watermarks.itertuples(index=False)
+        }
 
-            cnx.close()
+    def filters(self):
+        """
+        Filters of cleanUpData run by the db, so only the results of the
+        current races before year_threshold are fetched
+        """
+        where = [(f"CAST(year AS {self.dialect['integer']}) < {{}}", self.year_threshold)]
+        races = set(self.current_races)
+        if 'worldchampionship70.3' in races:
+            races.add('worldchampionship70.3m')
+        if len(races) > MAX_PARAMS:
+            # filtered by cleanUpData only
+            return {'where': where}
+        return {'where': where, 'filters': {'race': sorted(races)}}
+
+    def read(self):
+        """
+        Cleaned results of the current races, streamed from the db by
+        chunks, or from the local cache if the db didn't change
+        """
+        def short_hash(*values):
+            return hashlib.sha1('-'.join(values).encode()).hexdigest()[:16]
+
+        # results-<db>-<db version>-<races>: the reads of other race sets
+        # (IncrementalETL subsets, full runs) are kept as long as the db
+        # doesn't change
+        db_key = short_hash(self.backend, str(self.database), str(self.year_threshold))
+        version_key = short_hash(self.watermark())
+        races_key = short_hash(*sorted(set(self.current_races)))
+        cache_file = os.path.join(self.cache_dir, f"results-{db_key}-{version_key}-{races_key}")
+        if self.use_cache:
+            data = read_frame(cache_file)
+            if data is not None:
+                return data
+
+        query, params = self.db.select('results', self.columns, **self.filters())
+        data = concat_chunks([
+            self.cleanUpData(chunk)
+            for chunk in self.db.read_chunks(query, params, chunksize=self.chunksize)
+        ], columns=self.columns)
+
+        if self.use_cache:
+            # results of the previous versions of the db are outdated
+            current = os.path.join(self.cache_dir, f"results-{db_key}-{version_key}-")
+            for path in glob.glob(os.path.join(self.cache_dir, f"results-{db_key}-*")):
+                if not path.startswith(current):
+                    os.remove(path)
+            write_frame(data, cache_file)
+        return data
 
-            self.cleanUpData()
-            self.addFeatures()
+    def load(self, current_races=None):
+        with self._lock:
+            if current_races is not None and \
+               frozenset(current_races) != self._races_key:
+                self.current_races = current_races
+                self.data = None
+
+            if self.data is None:
+                self.data = self.read()
+
+                self.addFeatures()
+                self._races_key = frozenset(self.current_races)
+
+            return self.data
+
+    def preload(self, current_races):
+        """
+        Load the results of the races now (as the transformers would in
+        pandas mode), e.g. before the instance is copied to other processes
+        """
+        if self.mode != 'sql':
+            self.load(current_races=current_races)
+
+    def query(self, select, current_races=None):
+        """
+        Run an aggregation query on the results and return its (small)
+        output. The select can use the cleaned results as the `clean` table,
+        same filters as cleanUpData.
+        """
+        if current_races is not None:
+            self.current_races = current_races
+        races = list(self.current_races)
+        placeholder = self.dialect['placeholder']
+        race = ("CASE WHEN race = 'worldchampionship70.3m' "
+                "THEN 'worldchampionship70.3' ELSE race END")
+        year = f"CAST(year AS {self.dialect['integer']})"
+        sql = f"""
+            WITH clean AS (
+                SELECT {race} AS race, {year} AS year,
+                       athlete, country, division, date, swim, bike, run
+                FROM results
+                WHERE {year} < {placeholder}
+                  AND {race} IN ({', '.join([placeholder] * len(races))})
+            )
+            {select}
+        """
+        params = [self.year_threshold] + races
+
+        return self.db.read_sql(sql, params)
+
+    def mirror(self, database, backend='sqlite'):
+        """
+        Copy the cleaned results of the current races (see read) into a
+        local SQLite/DuckDB db, to run the sql mode without hitting MySQL
+        """
+        data = self.read()
+        mirrored = ResultsDf(backend=backend, database=database)
+        mirrored.db.write(data, 'results')
+        return mirrored
+
+
+def to_seconds(times):
+    """
+    Race times as integer seconds, from numbers or "h:mm:ss" strings
+    """
+    seconds = pd.to_numeric(times, errors='coerce')
+    as_text = seconds.isna() & times.notna()
+    if as_text.any():
+        seconds[as_text] = pd.to_timedelta(
+            times[as_text], errors='coerce').dt.total_seconds()
+    return seconds.round().astype('Int32')
+
+
+def type_results(data):
+    """
+    Compact types for the results table: categories for the repeated
+    strings, integer seconds for the times
+    """
+    data = data.copy()
+    for col in ['race', 'country', 'division']:
+        if col in data:
+            data[col] = data[col].astype('category')
+    for col in ['swim', 'bike', 'run']:
+        if col in data:
+            data[col] = to_seconds(data[col])
+    if 'date' in data:
+        data['date'] = pd.to_datetime(data['date'])
+    return data
+
+
+def concat_chunks(chunks, columns=None):
+    """
+    Concatenate typed chunks, keeping categorical columns categorical
+    """
+    if not chunks:
+        return type_results(pd.DataFrame(columns=columns))
+    for col in chunks[0].columns:
+        if isinstance(chunks[0][col].dtype, pd.CategoricalDtype):
+            categories = union_categoricals(
+                [chunk[col] for chunk in chunks]).categories
+            for chunk in chunks:
+                chunk[col] = pd.Categorical(chunk[col], categories=categories)
+    return pd.concat(chunks, ignore_index=True)
+
+
+def read_frame(path):
+    """
+    Read a dataframe saved with write_frame, None if there is none
+    """
+    if os.path.exists(f"{path}.parquet"):
+        return pd.read_parquet(f"{path}.parquet")
+    if os.path.exists(f"{path}.pkl"):
+        return pd.read_pickle(f"{path}.pkl")
+    return None
+
+
+def write_frame(df, path):
+    """
+    Save a dataframe as parquet, or pickle if no parquet engine is installed
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    try:
+        df.to_parquet(f"{path}.parquet", index=False)
+    except ImportError:
+        df.to_pickle(f"{path}.pkl")
+
+
+def write_profiles(path, *profiles):
+    """
+    Save the elevation profiles (ElevationMap.profiles_) of the same races
+    in one .npz file
+    """
+    arrays = {}
+    for profile in profiles:
+        if 'race' in arrays and not np.array_equal(arrays['race'], profile['race']):
+            raise ValueError("The profiles are not for the same races")
+        arrays.update(profile)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    np.savez(path, **arrays)
+
+
+def read_profiles(path):
+    """
+    Profiles saved with write_profiles, None if there are none
+    """
+    if not os.path.exists(path):
+        return None
+    with np.load(path) as data:
+        return {key: data[key] for key in data.files}
+
+
+def merge_profiles(previous, profile, races):
+    """
+    Profiles of the races (in this order), taken from profile, or from
+    previous for the races not in profile (or if there is no profile)
+    """
+    if profile is None:
+        profile = {key: values[:0] for key, values in previous.items()}
+    if previous is None:
+        previous = {key: values[:0] for key, values in profile.items()}
+    races = np.asarray(races, dtype=str)
+    new = pd.Index(profile['race']).get_indexer(races)
+    old = pd.Index(previous['race']).get_indexer(races)
+    if ((new < 0) & (old < 0)).any():
+        raise ValueError("No profile for some of the races")
+    from_new = new >= 0
+    merged = {'race': races}
+    for key, values in profile.items():
+        if key != 'race':
+            merged[key] = np.empty((len(races),) + values.shape[1:], dtype=values.dtype)
+            merged[key][from_new] = values[new[from_new]]
+            merged[key][~from_new] = previous[key][old[~from_new]]
+    return merged
+
+
+class RacesTracks:
+    """
+    GPS tracks of the races, parsed from the `map` column of the races
+    table: {race: {'run'/'bike': {'points', 'distance', 'elevation'}}},
+    as numpy arrays.
+
+    One instance can be shared by the route based transformers, the map
+    JSON is then only decoded once per race.
+    """
+    disciplines = ['run', 'bike']
+    fields = ['points', 'distance', 'elevation']
+
+    def __init__(self):
+        self.data = None
+        self._races_key = None
+        self._lock = threading.RLock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
+    @classmethod
+    def parse(cls, race_map):
+        race_map = json.loads(race_map)
+        return {
+            discipline: {
+                field: np.asarray(race_map[discipline][field], dtype=float)
+                for field in cls.fields
+            }
+            for discipline in cls.disciplines
+        }
 
-        return self.data
+    def load(self, races):
+        """
+        Tracks of the races of the dataframe (race and map columns), parsed
+        on first use or when the races change
+        """
+        races_key = frozenset(races['race'])
+        with self._lock:
+            if self.data is None or races_key != self._races_key:
+                self.data = {
+                    race: self.parse(race_map)
+                    for race, race_map in zip(races['race'], races['map'])
+                }
+                self._races_key = races_key
+            return self.data
 
 
 @dataclass
@@ -438,141 +861,129 @@ class Airports(BaseLoadCSV):
 
 @dataclass
 class MetropolitanArea(BaseLoadJSON):
+    # dict by race (see IncrementalETL)
+    by_race = True
     url = './../data/geo-data/races-metropolitan-area.json'
 
 
-# Distance for Geo info from Foursquare
-distance = 100
-
-
-@dataclass
-class Hotels(BaseLoadJSON):
-    url = f'./../data/geo-data/races-poi-hotels-{distance}km.json'
-
-
-@dataclass
-class Restaurants(BaseLoadJSON):
-    url = f'./../data/geo-data/races-poi-food-{distance}km.json'
-
-
-@dataclass
-class Entertainment(BaseLoadJSON):
-    url = f'./../data/geo-data/races-poi-entertainment-{distance}km.json'
-
-
-@dataclass
-class Nightlife(BaseLoadJSON):
-    url = f'./../data/geo-data/races-poi-nightlife-{distance}km.json'
-
-
 @dataclass
-class Shops(BaseLoadJSON):
-    url = f'./../data/geo-data/races-poi-shops_services-{distance}km.json'
+class FoursquarePOIs(BaseLoadJSON):
+    """
+    Foursquare venues of a category around the races, within distance (km)
+    """
+    category: str = ''
+    distance: int = 100
+    # dict by race (see IncrementalETL)
+    by_race = True
 
-
-@dataclass
-class BikeShops(BaseLoadJSON):
-    url = f'./../data/geo-data/races-poi-shops_bike-{distance}km.json'
-
-
-@dataclass
-class Pools(BaseLoadJSON):
-    url = f'./../data/geo-data/races-poi-pool-{distance}km.json'
-
-
-@dataclass
-class AthleticCenters(BaseLoadJSON):
-    url = f'./../data/geo-data/races-poi-athletic_centers-{distance}km.json'
-
-
-@dataclass
-class FitnessCenters(BaseLoadJSON):
-    url = f'./../data/geo-data/races-poi-fitness_centers-{distance}km.json'
+    @property
+    def url(self):
+        return f'./../data/geo-data/races-poi-{self.category}-{self.distance}km.json'
 
 
 @dataclass
-class Weather(BaseLoadJSON):
+class Weather(BaseLoadFile):
+    """
+    Weather of the editions of the races (Dark Sky), as a table with one row
+    by edition: race, id (race of the edition), year, icon, summary and the
+    min/max (apparent) temperatures of the day. Races without weather data
+    have a single row of NaN.
+    """
+    # table with a race column (see IncrementalETL)
+    by_race = True
     url = './../data/geo-data/races_weather.json'
-    _icons = {}
-    _summaries = {}
-    _temperatures = []
-
-    @property
-    def icons(self):
-        self.getIconsAndSummary()
-        return self._icons
 
-    @property
-    def summaries(self):
-        self.getIconsAndSummary()
-        return self._summaries
-
-    @property
-    def temperatures(self):
-        self.getIconsAndSummary()
-        return self._temperatures
-
-    def getIconsAndSummary(self):
-        if len(self._icons.keys()) == 0:
-            data = self.load()
-            for race in data:
-                editions = data[race]['editions']
-                self._icons[race] = []
-                self._summaries[race] = []
-                n_editions = len(editions)
-                i = 0
-                for edition in editions:
-                    daily_data = edition['weather'].get('daily', False)
-                    if daily_data:
-                        self._icons[race].append(daily_data['data'][0]['icon'])
-                        self._summaries[race].append(daily_data['data'][0]['summary'])
-                        # temperatures
-                        extract = {
-                            'race': edition['id'],
-                            'year': edition['date'].split('-')[0],
-                            'temperatureMin': edition['weather']['daily']['data'][0]['temperatureMin'],
-                            'temperatureMax': edition['weather']['daily']['data'][0]['temperatureMax'],
-                            'apparentTemperatureMin': edition['weather']['daily']['data'][0]['apparentTemperatureMin'],
-                            'apparentTemperatureMax': edition['weather']['daily']['data'][0]['apparentTemperatureMax']
-                        }
-                        self._temperatures.append(extract)
-                    else:
-                        i += 1
-                        hourly_data = edition['weather'].get('hourly')
-                        if hourly_data:
-                            i -= 1
-                            self._icons[race].append(hourly_data['icon'])
-                            self._summaries[race].append(hourly_data['summary'])
-                            # temperatures
-                            temperature = [t['temperature'] for t in edition['weather']['hourly']['data']]
-                            apparentTemperature = [t['apparentTemperature'] for t in edition['weather']['hourly']['data']]
-                            extract = {
-                                'race': edition['id'],
-                                'year': edition['date'].split('-')[0],
-                                'temperatureMin': np.min(temperature),
-                                'temperatureMax': np.max(temperature),
-                                'apparentTemperatureMin': np.min(apparentTemperature),
-                                'apparentTemperatureMax': np.max(apparentTemperature)
-                            }
-                            self._temperatures.append(extract)
-                        if i == n_editions:
-                            print(f'No icon/summary data for {race}')
+    temperatures = ['temperatureMin', 'temperatureMax',
+                    'apparentTemperatureMin', 'apparentTemperatureMax']
+
+    @staticmethod
+    def iter_races(path):
+        """
+        (race, weather of the race) of the file, streamed if ijson is installed
+        """
+        try:
+            import ijson
+        except ImportError:
+            with open(path, 'r') as f:
+                yield from json.load(f).items()
+            return
+        with open(path, 'rb') as f:
+            yield from ijson.kvitems(f, '', use_float=True)
+
+    @classmethod
+    def edition_weather(cls, weather):
+        """
+        [icon, summary, *temperatures] of the edition: from the daily data,
+        else the hourly data, None if it has neither
+        """
+        daily_data = weather.get('daily', False)
+        if daily_data:
+            day = daily_data['data'][0]
+            return [day['icon'], day['summary']] + [day[col] for col in cls.temperatures]
+        hourly_data = weather.get('hourly')
+        if hourly_data:
+            temperature = [t['temperature'] for t in hourly_data['data']]
+            apparentTemperature = [t['apparentTemperature'] for t in hourly_data['data']]
+            return [hourly_data['icon'], hourly_data['summary'],
+                    np.min(temperature), np.max(temperature),
+                    np.min(apparentTemperature), np.max(apparentTemperature)]
+        return None
+
+    def parse(self, path):
+        columns = ['race', 'id', 'year', 'icon', 'summary'] + self.temperatures
+        rows = []
+        for race, race_weather in self.iter_races(path):
+            editions = race_weather['editions']
+            n_rows = len(rows)
+            for edition in editions:
+                weather = self.edition_weather(edition['weather'])
+                if weather is not None:
+                    rows.append([race, edition['id'], int(edition['date'].split('-')[0])] + weather)
+            if len(rows) == n_rows:
+                if editions:
+                    print(f'No icon/summary data for {race}')
+                rows.append([race] + [None] * (len(columns) - 1))
+
+        editions = pd.DataFrame(rows, columns=columns)
+        return editions.astype({
+            'year': 'Int16',
+            'icon': 'category',
+            'summary': 'category',
+            **{col: 'float64' for col in self.temperatures}
+        })
+
+    @staticmethod
+    def most_frequent(editions, col):
+        """
+        Most frequent value of col by race, the first seen one on ties
+        """
+        values = editions[['race', col]].dropna()
+        counts = (
+            values.assign(position=np.arange(len(values)))
+                  .groupby(['race', col], observed=True, sort=False)['position']
+                  .agg(['size', 'min'])
+                  .reset_index()
+                  .sort_values(['size', 'min'], ascending=[False, True])
+                  .drop_duplicates('race')
+        )
+        return counts.set_index('race')[col].astype(object)
 
     def getSummaryDataFrame(self):
-        return pd.DataFrame([[
-            race,
-            max(self.icons[race] or ['partly-cloudy-day'], key=self.icons[race].count),
-            max(self.summaries[race] or ['Partly cloudy'], key=self.summaries[race].count)
-            ] for race in self.icons
-        ], columns=['race', 'weather_icon', 'weather_summary'])
+        editions = self.load()
+        races = editions['race'].drop_duplicates()
+        return pd.DataFrame({
+            'race': races.values,
+            'weather_icon': races.map(self.most_frequent(editions, 'icon'))
+                                 .fillna('partly-cloudy-day').values,
+            'weather_summary': races.map(self.most_frequent(editions, 'summary'))
+                                    .fillna('Partly cloudy').values
+        })
 
     def getTemperaturesDataFrame(self):
-        return (pd.DataFrame(self.temperatures)
-                    .groupby("race")[[
-                        'temperatureMin', 'temperatureMax',
-                        'apparentTemperatureMin', 'apparentTemperatureMax'
-                    ]]
+        return (self.load()
+                    .groupby('id')[self.temperatures]
                     .mean()
+                    .rename_axis('race')
                     .reset_index()
         )
         
\ No newline at end of file
@@ -0,0 +1,44 @@
+from sklearn.pipeline import Pipeline
+
+from transformers import ComputeRaceRouteFeatures, ComputeRaceHistoryStats,\
+    KeepActiveRacesOnly, RemoveDuplicates, CleanUpNames, AddCountryCode,\
+    FillMissingRegions, ExtractMonth, GetLatestDateAndLocation, SelectColumns,\
+    HasIronKids, RaceAttractivity, FractionOfHomeCountryRacer,\
+    FractionOfHomeRegionRacer, FemaleRatio, WorldChampionshipSlots,\
+    DistanceToNearestShoreline, DistanceToNearestAirport, GetNearbyFacilities,\
+    GetTypicalWeather, GetTypicalTemperatures, RacingTimesStatistics,\
+    RunElevationMap, BikeElevationMap, IsHalf
+
+
+def make_preprocessor(results=None, tracks=None):
+    """
+    Races features pipeline, results (ResultsDf) and tracks (RacesTracks)
+    are shared by the transformers using them
+    """
+    return Pipeline([
+        ("keep active races", KeepActiveRacesOnly()),
+        ("remove duplicates", RemoveDuplicates()),
+        ("format name", CleanUpNames()),
+        ("add country code", AddCountryCode()),
+        ("fill missing world regions", FillMissingRegions()),
+        ("extract month from date", ExtractMonth()),
+        ("update date and location", GetLatestDateAndLocation()),
+        ("extract history statistics", ComputeRaceHistoryStats()),
+        ("compute races geo features", ComputeRaceRouteFeatures(tracks=tracks)),
+        ("extract ironKids race information", HasIronKids()),
+        ("compute race attractivity coefficient", RaceAttractivity(results=results)),
+        ("compute percentage of racers from country", FractionOfHomeCountryRacer(results=results)),
+        ("compute percentage of racers from world region", FractionOfHomeRegionRacer(results=results)),
+        ("compute percentage of females", FemaleRatio(results=results)),
+        ("get world championship qualifyers", WorldChampionshipSlots()),
+        ("calculate distance to nearest shoreline", DistanceToNearestShoreline()),
+        ("calculate distance to_nearest airport", DistanceToNearestAirport()),
+        ("get touristic facilities nearby", GetNearbyFacilities()),
+        ("get typical weather", GetTypicalWeather()),
+        ("get typical temperatures", GetTypicalTemperatures()),
+        ("compute race times statistics", RacingTimesStatistics(results=results)),
+        ("get run profile", RunElevationMap(tracks=tracks, as_json=False)),
+        ("get bike profile", BikeElevationMap(tracks=tracks, as_json=False)),
+        ("extract race type (70.3/full) information", IsHalf()),
+        ("select only relevant columns", SelectColumns())
+    ])
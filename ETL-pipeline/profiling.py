@@ -0,0 +1,145 @@
+import json
+import os
+import resource
+import threading
+import time
+from datetime import datetime
+
+
+def current_rss():
+    """
+    Resident memory of the process (in bytes), None if it can't be read
+    (psutil if installed, /proc otherwise)
+    """
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError):
+        return None
+
+
+def max_rss():
+    """
+    Peak resident memory of the process so far (in bytes)
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if os.uname().sysname == 'Darwin' else peak * 1024
+
+
+class MemorySampler:
+    """
+    Peak resident memory while running a block, sampled in a thread.
+    Falls back on the peak of the process (only sees new peaks) if the
+    current memory can't be read.
+    """
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+
+    def __enter__(self):
+        self.start = current_rss()
+        self.start_max = max_rss()
+        self.peak = self.start
+        self._stop = threading.Event()
+        if self.start is not None:
+            self._thread = threading.Thread(target=self.sample, daemon=True)
+            self._thread.start()
+        return self
+
+    def sample(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, current_rss())
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        if self.start is not None:
+            self._thread.join()
+            self.peak = max(self.peak, current_rss())
+            self.delta = self.peak - self.start
+        else:
+            self.delta = max_rss() - self.start_max
+
+
+class StepProfiler:
+    """
+    Run the steps of a pipeline of transformers recording, for each step,
+    wall time, CPU time (of the process), peak resident memory increase
+    and rows/columns of its input and output.
+
+    Prints a summary table and writes the report as JSON in report_dir
+    (etl-profile-<date>.json), to compare runs as the data grows.
+    """
+    report_dir = "./../data/reports"
+
+    def __init__(self, report_dir=None, verbose=True):
+        self.report_dir = report_dir or self.report_dir
+        self.verbose = verbose
+
+    def fit_transform(self, pipeline, X):
+        steps = []
+        for i, (name, step) in enumerate(pipeline.steps):
+            rows_in, columns_in = X.shape
+            wall, cpu = time.perf_counter(), time.process_time()
+            with MemorySampler() as memory:
+                X = step.fit_transform(X)
+            steps.append({
+                'step': i,
+                'name': name,
+                'transformer': type(step).__name__,
+                'wall_time': time.perf_counter() - wall,
+                'cpu_time': time.process_time() - cpu,
+                'peak_rss_delta': memory.delta,
+                'rows_in': rows_in,
+                'columns_in': columns_in,
+                'rows_out': X.shape[0],
+                'columns_out': X.shape[1]
+            })
+
+        self.report_ = {
+            'date': datetime.now().isoformat(timespec='seconds'),
+            'wall_time': sum(step['wall_time'] for step in steps),
+            'cpu_time': sum(step['cpu_time'] for step in steps),
+            'steps': steps
+        }
+        self.save()
+        if self.verbose:
+            print(self.summary())
+        return X
+
+    @property
+    def report_path(self):
+        return os.path.join(self.report_dir,
+                            f"etl-profile-{self.report_['date'].replace(':', '')}.json")
+
+    def save(self):
+        os.makedirs(self.report_dir, exist_ok=True)
+        with open(self.report_path, 'w') as f:
+            json.dump(self.report_, f, indent=2)
+
+    def summary(self):
+        header = f"{'step':<45} {'wall (s)':>9} {'cpu (s)':>9} {'peak rss':>10} {'rows':>15} {'columns':>9}"
+        lines = [header, '-' * len(header)]
+        for step in self.report_['steps']:
+            lines.append(
+                f"{step['name'][:45]:<45} {step['wall_time']:>9.2f} {step['cpu_time']:>9.2f} "
+                f"{format_bytes(step['peak_rss_delta']):>10} "
+                f"{step['rows_in']:>7}->{step['rows_out']:<6} "
+                f"{step['columns_in']:>4}->{step['columns_out']:<3}")
+        lines.append('-' * len(header))
+        lines.append(f"{'total':<45} {self.report_['wall_time']:>9.2f} {self.report_['cpu_time']:>9.2f}")
+        lines.append(f"report saved to {self.report_path}")
+        return '\n'.join(lines)
+
+
+def format_bytes(size):
+    for unit in ['B', 'kB', 'MB']:
+        if abs(size) < 1024:
+            return f"{size:.0f}{unit}"
+        size /= 1024
+    return f"{size:.1f}GB"
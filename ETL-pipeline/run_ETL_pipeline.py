@@ -1,64 +1,78 @@
-import mysql.connector
-import pandas as pd
-from sklearn.pipeline import Pipeline
-
 from config import Cfg as cfg
 
-from transformers import ComputeRaceRouteFeatures, ComputeRaceHistoryStats,\
-    KeepActiveRacesOnly, RemoveDuplicates, CleanUpNames, AddCountryCode,\
-    FillMissingRegions, ExtractMonth, GetLatestDateAndLocation, SelectColumns,\
-    HasIronKids, RaceAttractivity, FractionOfHomeCountryRacer,\
-    FractionOfHomeRegionRacer, FemaleRatio, WorldChampionshipSlots,\
-    DistanceToNearestShoreline, DistanceToNearestAirport, GetNearbyFacilities,\
-    GetTypicalWeather, GetTypicalTemperatures, RacingTimesStatistics,\
-    RunElevationMap, BikeElevationMap, IsHalf
+from checkpoints import StepCheckpoints
+from incremental import IncrementalETL
+from scheduler import StageRunner
+from profiling import StepProfiler
+from load_ext import Races, ResultsDf, RacesTracks, write_profiles,\
+    read_profiles, merge_profiles
+from pipeline import make_preprocessor
+
 
+# Load data from db (db_backend = 'sqlite' and db_path in config to run on
+# a local snapshot)
+df_races = Races().load()
 
-# Load data from db
-cnx = mysql.connector.connect(
-  user=cfg.mysql_user, database=cfg.mysql_db,
-  password=cfg.mysql_pw, ssl_disabled=True)
+# results table, loaded once and shared by the transformers
+# (results_mode = 'sql' in config to compute the aggregates in the db)
+results = ResultsDf(mode=getattr(cfg, 'results_mode', 'pandas'))
+# GPS tracks, parsed once for the route based transformers
+tracks = RacesTracks()
 
-query = "SELECT * FROM races;"
-df_races = pd.read_sql(query, con=cnx)
 
-cnx.close()
+preprocessor = make_preprocessor(results=results, tracks=tracks)
 
+# etl_incremental = True in config to only compute the races which changed
+# since the previous run
+incremental = getattr(cfg, 'etl_incremental', False)
+# etl_profile = True in config to time each step (report in data/reports)
+profile = getattr(cfg, 'etl_profile', False)
+# etl_n_jobs in config to run the independent steps in parallel
+# (etl_executor = 'process' to use processes instead of threads)
+n_jobs = getattr(cfg, 'etl_n_jobs', None)
+# steps already run on the same data are loaded from their checkpoint
+# (etl_checkpoints = False in config to run everything)
+checkpoints = getattr(cfg, 'etl_checkpoints', True)
 
-preprocessor = Pipeline([
-    ("keep active races", KeepActiveRacesOnly()),
-    ("remove duplicates", RemoveDuplicates()),
-    ("format name", CleanUpNames()),
-    ("add country code", AddCountryCode()),
-    ("fill missing world regions", FillMissingRegions()),
-    ("extract month from date", ExtractMonth()),
-    ("update date and location", GetLatestDateAndLocation()),
-    ("extract history statistics", ComputeRaceHistoryStats()),
-    ("compute races geo features", ComputeRaceRouteFeatures()),
-    ("extract ironKids race information", HasIronKids()),
-    ("compute race attractivity coefficient", RaceAttractivity()),
-    ("compute percentage of racers from country", FractionOfHomeCountryRacer()),
-    ("compute percentage of racers from world region", FractionOfHomeRegionRacer()),
-    ("compute percentage of females", FemaleRatio()),
-    ("get world championship qualifyers", WorldChampionshipSlots()),
-    ("calculate distance to nearest shoreline", DistanceToNearestShoreline()),
-    ("calculate distance to_nearest airport", DistanceToNearestAirport()),
-    ("get touristic facilities nearby", GetNearbyFacilities()),
-    ("get typical weather", GetTypicalWeather()),
-    ("get typical temperatures", GetTypicalTemperatures()),
-    ("compute race times statistics", RacingTimesStatistics()),
-    ("get run profile", RunElevationMap()),
-    ("get bike profile", BikeElevationMap()),
-    ("extract race type (70.3/full) information", IsHalf()),
-    ("select only relevant columns", SelectColumns())
-])
+# the run modes don't combine, the first one set is used
+modes = [name for name, on in [('etl_incremental', incremental), ('etl_profile', profile),
+                               ('etl_n_jobs', n_jobs), ('etl_checkpoints', checkpoints)] if on]
+if len(modes) > 1:
+    print(f"Warning: {modes[0]} is set, {', '.join(modes[1:])} ignored for this run")
 
-transformed_races = preprocessor.fit_transform(df_races)
+if incremental:
+    etl = IncrementalETL(preprocessor, "./../data/clean/races_features.csv",
+                         fingerprints_after="format name")
+    transformed_races = etl.fit_transform(df_races)
+elif profile:
+    transformed_races = StepProfiler().fit_transform(preprocessor, df_races)
+elif n_jobs:
+    transformed_races = StageRunner(
+        n_jobs=n_jobs, executor=getattr(cfg, 'etl_executor', 'thread')
+    ).fit_transform(preprocessor, df_races)
+elif checkpoints:
+    transformed_races = StepCheckpoints().fit_transform(preprocessor, df_races)
+else:
+    transformed_races = preprocessor.fit_transform(df_races)
+
+# elevation profiles, saved as arrays next to the features
+profiles = [getattr(preprocessor.named_steps["get run profile"], 'profiles_', None),
+            getattr(preprocessor.named_steps["get bike profile"], 'profiles_', None)]
+if incremental:
+    # only the computed races have new profiles
+    previous_profiles = read_profiles("./../data/clean/races_features.npz")
+    profiles = [merge_profiles(previous_profiles, profile, transformed_races['race'])
+                for profile in profiles]
 
 # save to flask app
 transformed_races.to_csv("./../flask_app/nostrappdamus/model/data/races_features.csv", index=False)
+write_profiles("./../flask_app/nostrappdamus/model/data/races_features.npz", *profiles)
 
 # save final
 transformed_races.to_csv("./../data/clean/races_features.csv", index=False)
+write_profiles("./../data/clean/races_features.npz", *profiles)
+
+if incremental:
+    etl.save_state()
 
 print('Race pipeline successfully run!')
@@ -0,0 +1,111 @@
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, \
+    FIRST_COMPLETED, wait
+
+from checkpoints import fitted_attributes
+
+
+def run_stage(step, X):
+    """
+    Run one step (in a worker), returns its output and fitted attributes
+    """
+    return step.fit_transform(X), fitted_attributes(step)
+
+
+def is_barrier(step):
+    """
+    Steps without declared columns may filter rows or rename races, they
+    run alone on the whole frame
+    """
+    return not (hasattr(step, 'requires') and hasattr(step, 'provides'))
+
+
+def depends_on(step, previous):
+    """
+    Does step have to wait for previous (which comes before it in the
+    pipeline)?
+    """
+    if is_barrier(step) or is_barrier(previous):
+        return True
+    provides = set(step.provides)
+    return bool(set(previous.provides) & set(step.requires)) or \
+        bool(provides & (set(previous.requires) | set(previous.provides)))
+
+
+class StageRunner:
+    """
+    Run the steps of a pipeline as a DAG: the transformers declare the
+    columns they use (requires) and add (provides), and the steps which
+    don't depend on each other run concurrently.
+
+    Each step gets the race and required columns of the frame, and its
+    provided columns are joined back by race. Steps without declarations
+    (row filters, race renaming, column selection) wait for all the
+    previous steps, and all the next steps wait for them.
+
+    Threads are used by default: the transformers share the results table
+    and the tracks. With processes, shared contexts are copied to each
+    worker: the results are loaded once here (see ResultsDf.preload) and
+    sent along with the steps.
+    """
+
+    def __init__(self, n_jobs=None, executor='thread', verbose=True):
+        self.n_jobs = n_jobs
+        self.executor = executor
+        self.verbose = verbose
+
+    def dependencies(self, steps):
+        return {
+            j: {i for i in range(j) if depends_on(steps[j][1], steps[i][1])}
+            for j in range(len(steps))
+        }
+
+    def fit_transform(self, pipeline, X):
+        steps = pipeline.steps
+        dependencies = self.dependencies(steps)
+        pool_class = ProcessPoolExecutor if self.executor == 'process' else ThreadPoolExecutor
+
+        done = set()
+        running = {}
+        with pool_class(max_workers=self.n_jobs) as pool:
+            while len(done) < len(steps):
+                for j, (name, step) in enumerate(steps):
+                    if j in done or j in running.values() or not dependencies[j] <= done:
+                        continue
+                    self.log(f"starting step {j}: {name}")
+                    stage_input = X if is_barrier(step) else \
+                        X[['race'] + [col for col in step.requires if col != 'race']]
+                    if self.executor == 'process':
+                        self.preload(step, stage_input)
+                    running[pool.submit(run_stage, step, stage_input)] = j
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    j = running.pop(future)
+                    step = steps[j][1]
+                    output, fitted = future.result()
+                    for attr, value in fitted.items():
+                        setattr(step, attr, value)
+                    X = output if is_barrier(step) else self.join(X, output, step.provides)
+                    done.add(j)
+        return X
+
+    @staticmethod
+    def preload(step, X):
+        """
+        Load the data shared by the steps (ResultsDf...) before the step
+        is copied to a worker, so the workers don't load it again
+        """
+        for value in step.get_params(deep=False).values():
+            if hasattr(value, 'preload'):
+                value.preload(X['race'])
+
+    @staticmethod
+    def join(X, output, columns):
+        return (X
+            .drop(columns=[col for col in columns if col in X.columns])
+            .merge(output[['race'] + columns], left_on="race", right_on="race", how="left")
+        )
+
+    def log(self, message):
+        if self.verbose:
+            print(message)
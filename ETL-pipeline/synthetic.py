@@ -0,0 +1,312 @@
+import json
+import os
+import sqlite3
+import numpy as np
+import pandas as pd
+
+from load_ext import IronKidsRacesManualMatched
+
+# ISO codes of the countries of CountryInfo (and a few without region)
+ISO_CODES = [
+    ('AD', 'AND'), ('AF', 'AFG'), ('AG', 'ATG'), ('AL', 'ALB'), ('AM', 'ARM'),
+    ('AO', 'AGO'), ('AR', 'ARG'), ('AT', 'AUT'), ('AU', 'AUS'), ('AZ', 'AZE'),
+    ('BB', 'BRB'), ('BD', 'BGD'), ('BE', 'BEL'), ('BF', 'BFA'), ('BG', 'BGR'),
+    ('BH', 'BHR'), ('BI', 'BDI'), ('BJ', 'BEN'), ('BN', 'BRN'), ('BO', 'BOL'),
+    ('BR', 'BRA'), ('BS', 'BHS'), ('BT', 'BTN'), ('BW', 'BWA'), ('BY', 'BLR'),
+    ('BZ', 'BLZ'), ('CA', 'CAN'), ('CD', 'COD'), ('CG', 'COG'), ('CI', 'CIV'),
+    ('SZ', 'SWZ'), ('CH', 'CHE'), ('AE', 'ARE'), ('GB', 'GBR'), ('US', 'USA'),
+    ('FR', 'FRA'), ('DE', 'DEU'), ('ES', 'ESP'), ('NZ', 'NZL')
+]
+MIDDLE_EAST = ['AE', 'BH']
+
+REGIONS = ['Europe', 'North America', 'Asia', 'Australia', 'South America',
+           'Africa', 'Middle East']
+DIVISIONS = ['M18-24', 'M25-29', 'M30-34', 'M35-39', 'M40-44', 'M45-49',
+             'F18-24', 'F25-29', 'F30-34', 'F35-39', 'F40-44', 'MPRO', 'FPRO', 'PC']
+WEATHER = [('clear-day', 'Clear throughout the day.'),
+           ('partly-cloudy-day', 'Partly cloudy throughout the day.'),
+           ('rain', 'Light rain in the afternoon.'),
+           ('wind', 'Breezy starting in the afternoon.')]
+POI_CATEGORIES = ['hotels', 'food', 'entertainment', 'nightlife', 'shops_services',
+                  'shops_bike', 'pool', 'athletic_centers', 'fitness_centers']
+
+
+class SyntheticData:
+    """
+    Synthetic inputs of the ETL, with the same schemas as the real ones:
+    races and results tables (in a SQLite db standing in for MySQL), and
+    the files of data/ read by the loaders (descriptions, entrants counts,
+    weather, POIs, shorelines, airports...).
+
+    Sizes are given for scale=1 (about the size of the real data) and
+    multiplied by scale, except for the reference data (shorelines,
+    airports, countries) which don't grow with the races.
+    """
+    n_races = 150
+    # editions of each race in the results, results by edition
+    n_editions = 6
+    results_by_edition = 100
+    # GPS points of the tracks
+    run_points = 300
+    bike_points = 900
+    # POIs listed by race and category (Foursquare returns at most 50)
+    pois_by_race = 10
+    n_shorelines = 20000
+    n_airports = 7000
+
+    def __init__(self, root, scale=1, seed=0):
+        # data/ is written in root, the ETL has to run from a sibling
+        # directory (paths of the loaders are ./../data/...)
+        self.root = root
+        self.scale = scale
+        self.rng = np.random.default_rng(seed)
+
+    @property
+    def data_dir(self):
+        return os.path.join(self.root, 'data')
+
+    @property
+    def database(self):
+        return os.path.join(self.data_dir, 'etl.db')
+
+    def path(self, *parts):
+        path = os.path.join(self.data_dir, *parts)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def generate(self):
+        races = self.races()
+        self.write_db(races, self.results(races))
+        self.write_races_files(races)
+        self.write_geo_files(races)
+        self.write_weather(races)
+        return self
+
+    def races(self):
+        n = max(2, int(round(self.n_races * self.scale)))
+        rng = self.rng
+        # one race out of three is a 70.3, plus the two world championship
+        # 70.3 races (same race, see RemoveDuplicates)
+        ids = [f"race{i:06d}" + ('70.3' if i % 3 == 0 else '') for i in range(n - 2)]
+        ids += ['worldchampionship70.3', 'worldchampionship70.3m']
+        n = len(ids)
+
+        lat = rng.uniform(-50, 65, n)
+        lon = rng.uniform(-160, 175, n)
+        dates = pd.to_datetime('2019-01-01') + pd.to_timedelta(rng.integers(0, 365, n), unit='D')
+
+        return pd.DataFrame({
+            'race': ids,
+            'racename': [f"IRONMAN {race.replace('70.3', ' 70.3')} O'Race" for race in ids],
+            'date': dates.date,
+            'imlink': [f"http://www.ironman.com/triathlon/events/{race}.aspx" for race in ids],
+            'city': [f"City {i}" for i in range(n)],
+            'image_url': [f"http://images.ironman.com/{race}.jpg" for race in ids],
+            'logo_url': [f"http://images.ironman.com/{race}-logo.png" for race in ids],
+            'region': rng.choice(REGIONS, n),
+            'images': [json.dumps([f"http://images.ironman.com/{race}-{i}.jpg" for i in range(3)])
+                       for race in ids],
+            'map': [self.race_map(la, lo) for la, lo in zip(lat, lon)],
+            # inactive races have no info
+            'info': [self.race_info() if rng.random() > 0.05 else None for _ in ids],
+            'ironkids_race': rng.integers(0, 2, n),
+            'country_code': rng.choice([alpha3 for _, alpha3 in ISO_CODES], n),
+            'lat': lat,
+            'lon': lon
+        })
+
+    def track(self, lat, lon, n_points):
+        rng = self.rng
+        points = np.column_stack([lon, lat]) + np.cumsum(rng.normal(scale=1e-3, size=(n_points, 2)), axis=0)
+        return {
+            'points': np.round(points, 6).tolist(),
+            'distance': np.round(np.cumsum(rng.uniform(0.01, 0.1, n_points)), 3).tolist(),
+            'elevation': np.round(100 + np.cumsum(rng.normal(size=n_points)), 1).tolist()
+        }
+
+    def race_map(self, lat, lon):
+        return json.dumps({
+            'run': self.track(lat, lon, self.run_points),
+            'bike': self.track(lat, lon, self.bike_points)
+        })
+
+    def race_info(self):
+        rng = self.rng
+        return json.dumps({
+            'run': {'distance': 21.1, 'elevationGain': int(rng.integers(0, 900)), 'score': int(rng.integers(1, 6))},
+            'bike': {'distance': 90.1, 'elevationGain': int(rng.integers(0, 3000)), 'score': int(rng.integers(1, 6))},
+            'swim': {'distance': 1.9, 'type': str(rng.choice(list('hlor')))}
+        })
+
+    def results(self, races):
+        rng = self.rng
+        n_races = len(races)
+        # results of each edition of each race
+        race = np.repeat(np.arange(n_races), self.n_editions * self.results_by_edition)
+        edition = np.tile(np.repeat(np.arange(self.n_editions), self.results_by_edition), n_races)
+        n = len(race)
+
+        year = 2018 - edition
+        race_dates = pd.to_datetime(races['date'])
+        date = pd.to_datetime(dict(
+            year=year, month=race_dates.dt.month.values[race], day=race_dates.dt.day.values[race]))
+
+        # athletes come back to the races, and often from the race country
+        athletes = max(1, n // 4)
+        countries = np.where(rng.random(n) < 0.4, races['country_code'].values[race],
+                             rng.choice([alpha3 for _, alpha3 in ISO_CODES], n))
+
+        return pd.DataFrame({
+            'race': races['race'].values[race],
+            'athlete': pd.Series(rng.integers(0, athletes, n)).map('Athlete {}'.format),
+            'country': countries,
+            'division': rng.choice(DIVISIONS, n),
+            'year': year,
+            'date': date.dt.strftime('%Y-%m-%d'),
+            'swim': self.times(rng.normal(2400, 500, n)),
+            'bike': self.times(rng.normal(10800, 1800, n)),
+            'run': self.times(rng.normal(7200, 1500, n))
+        })
+
+    def times(self, seconds):
+        """
+        Integer seconds as in the db, some -1 (DNF) and missing
+        """
+        times = pd.Series(np.abs(seconds).astype(int), dtype='Int32')
+        status = self.rng.random(len(times))
+        times[status < 0.02] = -1
+        times[(status >= 0.02) & (status < 0.03)] = pd.NA
+        return times
+
+    def write_db(self, races, results):
+        if os.path.exists(self.path('etl.db')):
+            os.remove(self.database)
+        cnx = sqlite3.connect(self.database)
+        try:
+            races.drop(columns=['country_code', 'lat', 'lon']).to_sql('races', cnx, index=False)
+            results.to_sql('results', cnx, index=False, chunksize=100000)
+            cnx.commit()
+        finally:
+            cnx.close()
+
+    def write_jl(self, path, items):
+        with open(self.path(*path), 'w') as f:
+            for item in items:
+                f.write(json.dumps(item) + '\n')
+
+    def write_json(self, path, data):
+        with open(self.path(*path), 'w') as f:
+            json.dump(data, f)
+
+    def write_races_files(self, races):
+        rng = self.rng
+        ids = races['race']
+        self.write_jl(['races', 'races-description.jl'], (
+            {'id': race, 'name': name, 'date': str(date), 'location': city}
+            for race, name, date, city in zip(ids, races['racename'], races['date'], races['city'])
+        ))
+        self.write_jl(['races', 'races-athletes-count.jl'], (
+            {'id': race, 'date': f"{year}-06-01", 'count': int(rng.integers(300, 3000))}
+            for race in ids for year in range(2018 - self.n_editions - 3, 2019)
+        ))
+        websites = {race: f"http://www.ironman.com/triathlon/events/americas/ironman/{race}"
+                    for race in ids}
+        self.write_jl(['races', 'races.jl'], (
+            {'id': race, 'name': name, 'website': f"{websites[race]}.aspx"}
+            for race, name in zip(ids, races['racename'])
+        ))
+        # IronKids races of one race out of four, and the manually matched ones
+        kids = [{'name': f"IRONKIDS {race} Fun Run", 'url': f"{websites[race]}/ironkids.aspx"}
+                for race in ids[::4]]
+        kids += [{'name': f"IRONKIDS {name}", 'url': 'http://www.ironkids.com/'}
+                 for name in IronKidsRacesManualMatched().load()]
+        self.write_jl(['races', 'ironKids-races.json'], kids)
+
+        qualifyers = [
+            (f"Ironman 70.3 {race[:-4]}" if race.endswith('70.3') else f"Ironman {race}", slots)
+            for race, slots in zip(ids[:-2], rng.choice([0, 30, 40, 50, 75], len(ids) - 2))
+        ]
+        pd.DataFrame(qualifyers, columns=['Competition', 'Slots']).to_csv(
+            self.path('races', 'qualifyiers-slots.csv'), index=False)
+
+    def write_geo_files(self, races):
+        rng = self.rng
+        ids = races['race']
+        self.write_json(['geo-data', 'races_geo_info.json'], {
+            race: {'components': {'ISO_3166-1_alpha-3': code},
+                   'geometry': {'lat': lat, 'lng': lon}}
+            for race, code, lat, lon in zip(ids, races['country_code'], races['lat'], races['lon'])
+        })
+        pd.DataFrame(ISO_CODES, columns=['alpha2', 'alpha3']).to_csv(
+            self.path('geo-data', 'country-codes.csv'), index=False)
+        pd.DataFrame({'alpha2': MIDDLE_EAST}).to_csv(
+            self.path('geo-data', 'country-codes-middle-east.csv'), index=False)
+
+        pd.DataFrame({
+            'lat': rng.uniform(-60, 70, self.n_shorelines),
+            'lon': rng.uniform(-180, 180, self.n_shorelines)
+        }).to_csv(self.path('geo-data', 'shorelines_lat_lon.csv'), index=False)
+
+        n = self.n_airports
+        airports = pd.DataFrame({
+            'id': np.arange(n),
+            'name': [f"Airport {i}" + (' International Airport' if i % 5 == 0 else '') for i in range(n)],
+            'city': [f"City {i}" for i in range(n)],
+            'country': rng.choice([alpha2 for alpha2, _ in ISO_CODES], n),
+            'iata': '\\N', 'icao': '\\N',
+            'lat': rng.uniform(-60, 70, n),
+            'lon': rng.uniform(-180, 180, n),
+            'altitude': rng.integers(0, 3000, n),
+            'timezone': 0, 'dst': 'U', 'tz': 'Etc/UTC', 'type': 'airport', 'source': 'OurAirports'
+        })
+        airports.to_csv(self.path('geo-data', 'openflights', 'airports.dat'), index=False, header=False)
+
+        self.write_json(['geo-data', 'races-metropolitan-area.json'], {
+            race: {'totalCount': int(count)} for race, count in zip(ids, rng.integers(0, 20, len(ids)))
+        })
+        for category in POI_CATEGORIES:
+            self.write_json(['geo-data', f'races-poi-{category}-100km.json'], {
+                race: self.race_pois(category, race, lat, lon)
+                for race, lat, lon in zip(ids, races['lat'], races['lon'])
+            })
+
+    def race_pois(self, category, race, lat, lon):
+        rng = self.rng
+        locations = np.column_stack([lat, lon]) + rng.normal(scale=0.3, size=(self.pois_by_race, 2))
+        return {
+            'poi_n_results': int(rng.integers(self.pois_by_race, 250)),
+            'items': [
+                {'venue': {'id': f"{category}-{race}-{i}",
+                           'location': {'lat': float(la), 'lng': float(lo)}}}
+                for i, (la, lo) in enumerate(locations)
+            ]
+        }
+
+    def write_weather(self, races):
+        rng = self.rng
+        weather = {}
+        for race, date in zip(races['race'], races['date']):
+            editions = []
+            for year in range(2018 - self.n_editions + 1, 2019):
+                icon, summary = WEATHER[rng.integers(len(WEATHER))]
+                temperature = rng.normal(20, 6)
+                edition = {'id': race, 'date': f"{year}-{date.month:02d}-{date.day:02d}"}
+                if rng.random() < 0.8:
+                    edition['weather'] = {'daily': {'data': [{
+                        'icon': icon, 'summary': summary,
+                        'temperatureMin': round(temperature - 5, 2),
+                        'temperatureMax': round(temperature + 5, 2),
+                        'apparentTemperatureMin': round(temperature - 6, 2),
+                        'apparentTemperatureMax': round(temperature + 6, 2)
+                    }]}}
+                else:
+                    # some editions only have hourly data
+                    hourly = temperature + 5 * np.sin(np.arange(24) / 24 * 2 * np.pi)
+                    edition['weather'] = {'hourly': {'icon': icon, 'summary': summary, 'data': [
+                        {'temperature': round(t, 2), 'apparentTemperature': round(t - 1, 2)}
+                        for t in hourly
+                    ]}}
+                editions.append(edition)
+            weather[race] = {'editions': editions}
+        self.write_json(['geo-data', 'races_weather.json'], weather)
+
@@ -6,12 +6,76 @@ import pandas as pd
 from sklearn.base import BaseEstimator, TransformerMixin
 from load_ext import RacesGeoInfo, RacesDescription, MissingRegions,\
                      RacesEntrantsCount, IronKidsRaces, AllRaces,\
-                     IronKidsRacesManualMatched, ResultsDf, CountryInfo,\
+                     IronKidsRacesManualMatched, ResultsDf, RacesTracks,\
+                     CountryInfo,\
                      CountryISOCodes, CountryISOCodesMiddleEast,\
                      WorldChampionshipQualifyers, Shorelines, Airports,\
-                     Hotels, Restaurants, Entertainment, Nightlife,\
-                     Shops, BikeShops, Pools, AthleticCenters,\
-                     FitnessCenters, MetropolitanArea, Weather
+                     FoursquarePOIs, MetropolitanArea, Weather
+from geo import GeoIndex
+
+
+def map_rows(X, func, columns, output):
+    """
+    Apply func to the values of columns (as arguments), row by row, without
+    building a Series for each row as X.transpose().apply does.
+
+    output is the name of the returned column if func returns a value, or
+    the names of the returned columns if it returns a dict/tuple. Columns
+    get their inferred dtype, or the one given by output as {name: dtype}.
+    """
+    values = [func(*row) for row in zip(*(X[col] for col in columns))]
+    if isinstance(output, str):
+        return pd.Series(values, index=X.index, name=output, dtype=object).infer_objects()
+    result = pd.DataFrame.from_records(values, index=X.index, columns=list(output))
+    if isinstance(output, dict):
+        return result.astype(output)
+    return result.infer_objects()
+
+
+class ResultsMixin:
+    """
+    For transformers using the results table. A ResultsDf can be given to
+    share the loaded results between transformers.
+
+    The transformers compute per race aggregates of the results, either in
+    pandas (aggregate) or, if the ResultsDf is in sql mode, directly in the
+    db (aggregate_sql, same output).
+    """
+
+    def __init__(self, results=None):
+        self.results = results
+
+    def get_aggregates(self, X):
+        results = self.results if self.results is not None else ResultsDf()
+        if results.mode == 'sql':
+            return results.query(self.aggregate_sql(results.dialect),
+                                 current_races=X['race'])
+        aggregates = self.aggregate(results.load(current_races=X['race']))
+        # back to plain values, aggregates are small
+        return aggregates.astype({
+            col: object for col in aggregates.columns
+            if isinstance(aggregates[col].dtype, pd.CategoricalDtype)
+        })
+
+    def aggregate(self, df_results):
+        raise NotImplementedError
+
+    def aggregate_sql(self, dialect):
+        raise NotImplementedError
+
+
+class TracksMixin:
+    """
+    For transformers using the GPS tracks of the races. A RacesTracks can
+    be given to share the parsed tracks between transformers.
+    """
+
+    def __init__(self, tracks=None):
+        self.tracks = tracks
+
+    def get_tracks(self, X):
+        tracks = self.tracks if self.tracks is not None else RacesTracks()
+        return tracks.load(X)
 
 
 class KeepActiveRacesOnly(BaseEstimator, TransformerMixin):
@@ -66,6 +130,10 @@ class AddCountryCode(BaseEstimator, TransformerMixin):
     """
     Add country code from geo file
     """
+    # columns used/added (see StageRunner)
+    requires = ['race']
+    provides = ['country_code']
+    sources = [RacesGeoInfo]
 
     def fit(self, X, y=None):
         return self
@@ -86,6 +154,9 @@ class ExtractMonth(BaseEstimator, TransformerMixin):
     """
     Extract month from date
     """
+    # columns used/added (see StageRunner)
+    requires = ['date']
+    provides = ['month']
 
     def fit(self, X, y=None):
         return self
@@ -98,6 +169,10 @@ class FillMissingRegions(BaseEstimator, TransformerMixin):
     """
     Fill in missing geo regions for specific races
     """
+    # columns used/added (see StageRunner)
+    requires = ['race', 'region']
+    provides = ['region']
+    sources = [MissingRegions]
 
     def fit(self, X, y=None):
         return self
@@ -106,10 +181,9 @@ class FillMissingRegions(BaseEstimator, TransformerMixin):
         missing_regions = MissingRegions().load()
 
         return X.assign(
-            region=(
-                X[['race', 'region']]
-                .transpose()
-                .apply(lambda x: missing_regions[x['race']] if x['race'] in missing_regions else x['region'])
+            region=X['region'].where(
+                ~X['race'].isin(list(missing_regions)),
+                X['race'].map(missing_regions)
             )
         )
 
@@ -118,6 +192,10 @@ class GetLatestDateAndLocation(BaseEstimator, TransformerMixin):
     """
     Ensure date and location are the latest available for each race
     """
+    # columns used/added (see StageRunner)
+    requires = ['race', 'date', 'month', 'city']
+    provides = ['date', 'month', 'city']
+    sources = [RacesDescription]
 
     @staticmethod
     def getDateAndLocation(race, date, month, city, descriptions):
@@ -128,11 +206,11 @@ class GetLatestDateAndLocation(BaseEstimator, TransformerMixin):
         new_date = to_check['date'] if to_check is not False else date if date else ''
         if type(new_date) == str and 'TBD' in new_date:
             new_date = f"TBD {month:02}-{new_date.split('TBD ')[1]}"
-        return pd.Series({
+        return {
             'date': new_date,
             'month': int(new_date.split('-')[1]) if type(new_date) == str and 'TBD' not in new_date and new_date != '' else month,
             'city': to_check['location'] if to_check is not False else city
-        })
+        }
 
     def fit(self, X, y=None):
         return self
@@ -141,10 +219,11 @@ class GetLatestDateAndLocation(BaseEstimator, TransformerMixin):
         # make sure to have latest date and location from latest download
         descriptions = RacesDescription().load()
 
-        updated_info = (
-            X.transpose()
-                .apply(lambda x: self.getDateAndLocation(x['race'], x['date'], x['month'], x['city'], descriptions))
-                .transpose()
+        updated_info = map_rows(
+            X,
+            lambda race, date, month, city: self.getDateAndLocation(race, date, month, city, descriptions),
+            ['race', 'date', 'month', 'city'],
+            ['date', 'month', 'city']
         )
 
         return X.assign(
@@ -158,6 +237,10 @@ class ComputeRaceHistoryStats(BaseEstimator, TransformerMixin):
     """
     Some statistics based on past race results
     """
+    # columns used/added (see StageRunner)
+    requires = ['race']
+    provides = ['n_years_existance', 'entrants_count_avg']
+    sources = [RacesEntrantsCount]
     year_threshold = 2014
 
     def get_race_participation(self, race, races_entrants_count):
@@ -177,10 +260,10 @@ class ComputeRaceHistoryStats(BaseEstimator, TransformerMixin):
         mean_count = np.nan if not mean_count else mean_count
         n_years_existance = np.nan if not n_years_existance else n_years_existance
 
-        return pd.Series({
+        return {
             'n_years_existance': n_years_existance,
             'entrants_count_avg': mean_count
-        })
+        }
 
     def fit(self, X, y=None):
         return self
@@ -190,13 +273,12 @@ class ComputeRaceHistoryStats(BaseEstimator, TransformerMixin):
 
         return pd.concat([
             X,
-            X.transpose()
-             .apply(lambda x: self.get_race_participation(x['race'], races_entrants_count))
-             .transpose()
+            map_rows(X, lambda race: self.get_race_participation(race, races_entrants_count),
+                     ['race'], {'n_years_existance': float, 'entrants_count_avg': float})
         ], axis=1)
 
 
-class ComputeRaceRouteFeatures(BaseEstimator, TransformerMixin):
+class ComputeRaceRouteFeatures(TracksMixin, BaseEstimator, TransformerMixin):
     """
     Extract info from GPS tracks and co
     """
@@ -210,26 +292,29 @@ class ComputeRaceRouteFeatures(BaseEstimator, TransformerMixin):
     }
 
     @staticmethod
-    def get_angle_between(v1, v2, degrees=False):
-        angle = np.math.atan2(np.linalg.det([v1, v2]), np.dot(v1, v2))
-        if degrees:
-            angle = np.degrees(angle)
-        return angle
-
-    def get_successive_angles(self, x, y):
-        x_diff = x[1:] - x[:-1]
-        y_diff = y[1:] - y[:-1]
-        angles = []
-        for i in range(len(x_diff) - 1):
-            v1 = [x_diff[i], y_diff[i]]
-            v2 = [x_diff[i + 1], y_diff[i + 1]]
-            angles.append(np.abs(self.get_angle_between(v1, v2, degrees=True)))
-        return np.array(angles)
-
-    def extract_geo_info(self, race_map, race_info):
+    def get_successive_angles(x, y):
+        """
+        Absolute turning angles (in degrees) between successive segments
+        of the route, computed for all the points at once
+        """
+        x_diff = np.diff(x)
+        y_diff = np.diff(y)
+        # cross and dot products of each segment with the next one
+        cross = x_diff[:-1] * y_diff[1:] - y_diff[:-1] * x_diff[1:]
+        dot = x_diff[:-1] * x_diff[1:] + y_diff[:-1] * y_diff[1:]
+        return np.abs(np.degrees(np.arctan2(cross, dot)))
+
+    # columns used/added (see StageRunner), extract_geo_info columns
+    requires = ['race', 'map', 'info']
+    provides = [
+        'lat', 'lon', 'run_sinusoity', 'run_distance', 'run_elevationGain',
+        'run_score', 'bike_sinusoity', 'bike_distance', 'bike_elevationGain',
+        'bike_score', 'swim_distance', 'swim_type'
+    ]
+
+    def extract_geo_info(self, track, race_info):
         # get lat/lon by averaging run points
-        run_map = json.loads(race_map)['run']
-        run_data = np.array(run_map['points'])
+        run_data = track['run']['points']
         lon = run_data[:, 0].mean()
         lat = run_data[:, 1].mean()
 
@@ -237,14 +322,13 @@ class ComputeRaceRouteFeatures(BaseEstimator, TransformerMixin):
         run_sinusoity = self.get_successive_angles(run_data[:, 0], run_data[:, 1]).mean()
 
         # sinusoity of bike route
-        bike_map = json.loads(race_map)['bike']
-        bike_data = np.array(bike_map['points'])
+        bike_data = track['bike']['points']
         bike_sinusoity = self.get_successive_angles(bike_data[:, 0], bike_data[:, 1]).mean()
 
         # infos
         infos = json.loads(race_info)
 
-        return pd.Series({
+        return {
             'lat': lat,
             'lon': lon,
             'run_sinusoity': run_sinusoity,
@@ -257,17 +341,17 @@ class ComputeRaceRouteFeatures(BaseEstimator, TransformerMixin):
             'bike_score': infos['bike']['score'],
             'swim_distance': infos['swim']['distance'],
             'swim_type': self.swim_type[infos['swim']['type']]
-        })
+        }
 
     def fit(self, X, y=None):
         return self
 
     def transform(self, X):
+        tracks = self.get_tracks(X)
         return pd.concat([
             X,
-            X.transpose()
-             .apply(lambda x: self.extract_geo_info(x['map'], x['info']))
-             .transpose()
+            map_rows(X, lambda race, info: self.extract_geo_info(tracks[race], info),
+                     ['race', 'info'], self.provides)
         ], axis=1)
 
 
@@ -275,6 +359,10 @@ class HasIronKids(BaseEstimator, TransformerMixin):
     """
     Does the race have ironKids race
     """
+    # columns used/added (see StageRunner)
+    requires = ['race']
+    provides = ['hasIronKids']
+    sources = [IronKidsRaces, AllRaces, IronKidsRacesManualMatched]
 
     @staticmethod
     def getIronKidsRaces():
@@ -289,7 +377,8 @@ class HasIronKids(BaseEstimator, TransformerMixin):
         return IronKidsRacesManualMatched().load()
 
     def getMatchedIronKidsRaces(self):
-        ironKids_races = self.getIronKidsRaces()
+        # copies, the loaded races are shared
+        ironKids_races = {name: dict(race) for name, race in self.getIronKidsRaces().items()}
         all_races = self.getAllRaces()
 
         not_matched = []
@@ -350,11 +439,16 @@ class HasIronKids(BaseEstimator, TransformerMixin):
         )
 
 
-class RaceAttractivity(BaseEstimator, TransformerMixin):
+class RaceAttractivity(ResultsMixin, BaseEstimator, TransformerMixin):
     """
     Feature computed based on the behavior of athletes who have the possibility
     of coming back to a race. Do they actually returns?
     """
+    # columns used/added (see StageRunner)
+    requires = ['race']
+    provides = ['attractivity_score']
+    # the C/m priors are computed over all the races (see IncrementalETL)
+    per_race = False
 
     def weighted_ratio(self, df, m=None, C=None):
         '''
@@ -372,9 +466,7 @@ class RaceAttractivity(BaseEstimator, TransformerMixin):
     def fit(self, X, y=None):
         return self
 
-    def transform(self, X):
-        df_results = ResultsDf(current_races=X['race']).load()
-
+    def aggregate(self, df_results):
         # keep only athletes that have done more than one season
         # so they had the ability to redo the same race if they wanted
         df_multi_season = df_results.loc[df_results["years_in_sport"] > 1]
@@ -382,10 +474,10 @@ class RaceAttractivity(BaseEstimator, TransformerMixin):
         # number of editions of the race
         n_editions = (
             df_multi_season
-                .groupby(['race', 'year'])
+                .groupby(['race', 'year'], observed=True)
                 .size()
                 .reset_index()
-                .groupby('race')
+                .groupby('race', observed=True)
                 .size()
                 .rename("n_edition")
         )
@@ -393,7 +485,7 @@ class RaceAttractivity(BaseEstimator, TransformerMixin):
         # how many times races have been raced by those multi-season athletes?
         total_hits = (
             df_multi_season
-                .groupby(['race'])
+                .groupby(['race'], observed=True)
                 .size()
                 .reset_index()
                 .rename(columns={0: "total_hits"})
@@ -402,19 +494,37 @@ class RaceAttractivity(BaseEstimator, TransformerMixin):
         # how many times multi-season athletes returned to race again the same race?
         returned_hits = (
             df_multi_season
-                .groupby(['race', 'athlete'])
+                .groupby(['race', 'athlete'], observed=True)
                 .size()
                 .reset_index()
-                .groupby('race')
+                .groupby('race', observed=True)
                 .size()
                 .rename("returned_hits")
         )
 
-        df_results = (
+        return (
             total_hits
                 .merge(returned_hits, left_on="race", right_on="race", how="left")
                 .merge(n_editions, left_on="race", right_on="race", how="left")
         )
+
+    def aggregate_sql(self, dialect):
+        # years_in_sport > 1 means at least a year between first and last race
+        days_in_sport = dialect['days_between'].format(col='date')
+        return f"""
+            SELECT clean.race,
+                   COUNT(*) AS total_hits,
+                   COUNT(DISTINCT clean.athlete) AS returned_hits,
+                   COUNT(DISTINCT clean.year) AS n_edition
+            FROM clean
+            JOIN (SELECT athlete FROM clean GROUP BY athlete
+                  HAVING {days_in_sport} >= 365.2425) multi_season
+              ON clean.athlete = multi_season.athlete
+            GROUP BY clean.race
+        """
+
+    def transform(self, X):
+        df_results = self.get_aggregates(X)
         df_results["ratio"] = df_results['returned_hits'] / df_results['total_hits']
 
         # Only the races with more than 1 editions have potential returning entrants.
@@ -435,24 +545,36 @@ class RaceAttractivity(BaseEstimator, TransformerMixin):
                        left_on="race", right_on="race", how="left")
 
 
-class FractionOfHomeCountryRacer(BaseEstimator, TransformerMixin):
+class FractionOfHomeCountryRacer(ResultsMixin, BaseEstimator, TransformerMixin):
     """
     Compute the percentage of people from country of the race
     """
+    # columns used/added (see StageRunner)
+    requires = ['race', 'country_code']
+    provides = ['perc_entrants_from_country']
 
     def fit(self, X, y=None):
         return self
 
-    def transform(self, X):
-        df_results = ResultsDf(current_races=X['race']).load()
-
-        nationalities = (df_results
-            .groupby(['race', 'country'])
+    def aggregate(self, df_results):
+        return (df_results
+            .groupby(['race', 'country'], observed=True)
             .size()
             .reset_index()
             .rename(columns={0: 'count'})
-            .pivot(index='race', columns='country', values='count')
+        )
+
+    def aggregate_sql(self, dialect):
+        return """
+            SELECT race, country, COUNT(*) AS count
+            FROM clean
+            WHERE country IS NOT NULL
+            GROUP BY race, country
+        """
 
+    def transform(self, X):
+        nationalities = (self.get_aggregates(X)
+            .pivot(index='race', columns='country', values='count')
         )
 
         from_country = pd.DataFrame(list(
@@ -477,160 +599,171 @@ class FractionOfHomeCountryRacer(BaseEstimator, TransformerMixin):
                        left_on="race", right_on="race", how="left")
 
 
-class FractionOfHomeRegionRacer(BaseEstimator, TransformerMixin):
+class FractionOfHomeRegionRacer(ResultsMixin, BaseEstimator, TransformerMixin):
     """
     Compute the percentage of people from region of the race
     """
-
-    codes = CountryISOCodes().load()
-    codes_middle_east = CountryISOCodesMiddleEast().load()
-    countries = CountryInfo().load()
-
-    def get_region_from_ISO3(self, ISO3_code, changeOceania=False):
-        # get ISO-2 correspondance
-        ISO2_code = self.codes.loc[self.codes['alpha3'] == ISO3_code, 'alpha2'].values
-        ISO2_code = ISO2_code[0] if len(ISO2_code) else False
-        return self.get_region_from_ISO2(ISO2_code, changeOceania)
-
-    def get_region_from_ISO2(self, ISO2_code, changeOceania=False):
-        if ISO2_code and ISO2_code not in self.codes_middle_east['alpha2'].tolist():
-            country = list(filter(lambda x: x['code'] == ISO2_code, self.countries))
-            if len(country):
-                region = country[0].get('continent', False)
-                if changeOceania and region == "Oceania":
-                    # oceania is referred as Australia in races regions
-                    region = 'Australia'
-                return region
-            else:
-                return ''
-        elif ISO2_code and ISO2_code in self.codes_middle_east['alpha2'].tolist():
-            return 'Middle East'
-        else:
-            return ''
-
-    def get_race_region(self, race, races_df):
-        if race:
-            region = races_df.loc[races_df.race == race, 'region']
-            if len(region) > 0:
-                return region.values[0]
-            else:
-                return 'None'
-        else:
-            return 'None'
+    # columns used/added (see StageRunner)
+    requires = ['race', 'region']
+    provides = ['perc_entrants_from_region']
+    sources = [CountryISOCodes, CountryISOCodesMiddleEast, CountryInfo]
 
     @staticmethod
-    def assign_region(race, region, regionalities):
-        if region in regionalities.columns:
-            return regionalities.loc[race, region]
-        else:
-            return np.nan
+    def regions_by_ISO3():
+        """
+        Lookup table of the regions of the countries, by ISO3 code ('' if
+        unknown)
+        """
+        codes = CountryISOCodes().load()
+        codes_middle_east = CountryISOCodesMiddleEast().load()
+
+        # first entry of each country code, as the codes may repeat
+        continents = {}
+        for country in CountryInfo().load():
+            continents.setdefault(country['code'], country.get('continent', False))
+        continents = pd.Series(continents, dtype=object).replace(
+            # oceania is referred as Australia in races regions
+            'Oceania', 'Australia')
+
+        ISO2_codes = (codes
+            .drop_duplicates('alpha3')
+            .set_index('alpha3')['alpha2']
+        )
+        regions = ISO2_codes.map(continents).fillna('')
+        regions[ISO2_codes.isin(codes_middle_east['alpha2'])] = 'Middle East'
+        return regions
 
     def fit(self, X, y=None):
         return self
 
-    def transform(self, X):
-        df_results = ResultsDf(current_races=X['race']).load()
-
-        # add region to each athlete
-        df_results['region'] = None
-
-        groups_indices = []
-        for g, dgroup in df_results.groupby('country'):
-            groups_indices.append((g, dgroup.index))
-
-        for (country_code_iso3, indices) in groups_indices:
-            df_results.loc[indices, 'region'] = self.get_region_from_ISO3(
-                country_code_iso3, changeOceania=True)
-
-        regionalities = (df_results
-            .groupby(['race', 'region'])
+    def aggregate(self, df_results):
+        return (df_results
+            .groupby(['race', 'country'], observed=True)
             .size()
             .reset_index()
             .rename(columns={0: 'count'})
-            .pivot(index='race', columns='region', values='count')
-
         )
 
-        from_region = pd.DataFrame(list(
-            regionalities.index.map(lambda race:
-                {'index': race,
-                'from_region': self.assign_region(
-                    race, self.get_race_region(race, X), regionalities
-                )}
-            )
-        ))
+    def aggregate_sql(self, dialect):
+        return """
+            SELECT race, country, COUNT(*) AS count
+            FROM clean
+            WHERE country IS NOT NULL
+            GROUP BY race, country
+        """
 
-        from_region = from_region.set_index('index')
+    def transform(self, X):
+        nationalities = self.get_aggregates(X)
 
-        from_region = pd.concat([
-            regionalities.sum(axis=1).rename("total"),
-            from_region], axis=1)
+        # add region to each nationality
+        nationalities['region'] = (nationalities['country']
+            .map(self.regions_by_ISO3())
+            .fillna('')
+        )
 
-        from_region['perc_entrants_from_region'] = from_region['from_region'] / from_region['total']
-        from_region['race'] = from_region.index
+        regionalities = (nationalities
+            .groupby(['race', 'region'])['count']
+            .sum()
+        )
 
-        return X.merge(from_region[['race', 'perc_entrants_from_region']],
-                       left_on="race", right_on="race", how="left")
+        # entrants from the region of the race, looked up by (race, region)
+        races_regions = X.drop_duplicates('race').set_index('race')['region']
+        total = regionalities.groupby(level='race').sum()
+        from_region = regionalities.reindex(pd.MultiIndex.from_arrays([
+            total.index, total.index.map(races_regions)
+        ]))
 
+        return X.merge(
+            pd.DataFrame({
+                'race': total.index,
+                'perc_entrants_from_region': from_region.values / total.values
+            }),
+            left_on="race", right_on="race", how="left")
 
-class FemaleRatio(BaseEstimator, TransformerMixin):
+
+class FemaleRatio(ResultsMixin, BaseEstimator, TransformerMixin):
     """
     Compute the ratio females/males
     """
+    # columns used/added (see StageRunner)
+    requires = ['race']
+    provides = ['perc_female']
 
     def fit(self, X, y=None):
         return self
 
+    def aggregate(self, df_results):
+        # the results are shared with other transformers, work on a copy
+        df_results = df_results[['race', 'year', 'division']].copy()
+
+        division = df_results['division'].astype(str)
+        df_results['gender'] = np.select(
+            [division.str.contains('F'), division.str.contains('M')],
+            ['F', 'M'], default=None)
+
+        return (df_results
+            .groupby(['race', 'year', 'gender'], observed=True)
+            .size()
+            .reset_index()
+            .rename(columns={0: 'count'})
+        )
+
+    def aggregate_sql(self, dialect):
+        contains = dialect['contains']
+        return f"""
+            SELECT race, year, gender, COUNT(*) AS count
+            FROM (
+                SELECT race, year,
+                       CASE WHEN {contains.format(col='division', sub='F')} THEN 'F'
+                            WHEN {contains.format(col='division', sub='M')} THEN 'M'
+                       END AS gender
+                FROM clean
+            ) genders
+            WHERE gender IS NOT NULL
+            GROUP BY race, year, gender
+        """
+
     def transform(self, X):
-        df_results = ResultsDf(current_races=X['race']).load()
-
-        df_results['gender'] = None
-        df_results.loc[df_results.division.str.contains('M'), 'gender'] = 'M'
-        df_results.loc[df_results.division.str.contains('F'), 'gender'] = 'F'
-
-        gender_balance = {}
-        for race in df_results.race.unique():
-            gender_balance[race] = {}
-            balance = pd.DataFrame(df_results.loc[df_results.race == race]
-                 .groupby(['year', 'gender'])
-                 .size()
-                 .reset_index()
-                 .rename(columns={0: 'count'})
-                 .pivot(index='year', columns='gender', values='count')
-            )
-            balance['total'] = balance.F + balance.M
-            balance['ratio_F'] = balance.F/balance.total
-            gender_balance[race]['data'] = balance.to_dict(orient='records')
-            gender_balance[race]['avg_F'] = balance.ratio_F.mean()
-
-        gender_balance_df = pd.DataFrame([
-            {'race': race,
-             'perc_female': gender_balance[race]['avg_F'],
-             'n_years': len(gender_balance[race]['data']),
-             'avg_total': pd.DataFrame(gender_balance[race]['data']).mean()['total'],
-             'type': '70.3' if '70.3' in race else 'full'
-            } for race in gender_balance
-        ])
-
-        return X.merge(gender_balance_df[['race', 'perc_female']],
-                       left_on="race", right_on="race", how="left")
+        df_counts = self.get_aggregates(X)
+
+        # females/males counts of each edition
+        balance = (df_counts
+            .set_index(['race', 'year', 'gender'])['count']
+            .unstack('gender')
+            .reindex(columns=['F', 'M'])
+        )
+        ratio_F = balance['F'] / (balance['F'] + balance['M'])
+
+        perc_female = (ratio_F
+            .groupby(level='race', sort=False)
+            .mean()
+            .rename('perc_female')
+            .reset_index()
+        )
+
+        return X.merge(perc_female, left_on="race", right_on="race", how="left")
 
 
 class WorldChampionshipSlots(BaseEstimator, TransformerMixin):
     """
     Compute the ratio females/males
     """
-
-    qualifyers = WorldChampionshipQualifyers().load()
+    # columns used/added (see StageRunner)
+    requires = ['race']
+    provides = ['wc_slots']
+    sources = [WorldChampionshipQualifyers]
+    # slots go to the first matching race among all the races
+    per_race = False
 
     def fit(self, X, y=None):
         return self
 
     def transform(self, X):
+        qualifyers = WorldChampionshipQualifyers().load()
         wc_slots = pd.DataFrame(X['race'])
         wc_slots['wc_slots'] = 0
 
-        for race, slots in self.qualifyers.loc[:, ["Competition", "Slots"]].values:
+        for race, slots in qualifyers.loc[:, ["Competition", "Slots"]].values:
             racename = race.split("Ironman ")[1].lower()
 
             isHalf = False
@@ -660,40 +793,20 @@ class DistanceToNearestShoreline(BaseEstimator, TransformerMixin):
     """
     Compute distance to neareast coast
     """
-
-    shorelines = Shorelines().load()
-
-    @staticmethod
-    def haversine(lat1, lon1, lat2, lon2):
-        """
-        Calculate distance (in meters) between two lat/lon pairs
-        """
-        lat1_rad = np.radians(lat1)
-        lat2_rad = np.radians(lat2)
-        lon1_rad = np.radians(lon1)
-        lon2_rad = np.radians(lon2)
-        delta_lat = lat2_rad - lat1_rad
-        delta_lon = lon2_rad - lon1_rad
-        a = np.sqrt((np.sin(delta_lat / 2)) ** 2 + np.cos(lat1_rad) * np.cos(lat2_rad) * (np.sin(delta_lon / 2)) ** 2)
-        d = 2 * 6371000 * np.arcsin(a)
-        return d
+    # columns used/added (see StageRunner)
+    requires = ['lat', 'lon']
+    provides = ['distance_to_nearest_shoreline']
+    sources = [Shorelines]
 
     def fit(self, X, y=None):
         return self
 
     def transform(self, X):
+        # nearest point of all the races at once
+        shorelines = GeoIndex.load(Shorelines.url, 'shorelines',
+                                   lambda: Shorelines().load())
         return X.assign(
-            distance_to_nearest_shoreline=(
-                X[['lat', 'lon']]
-                    .transpose()
-                    .apply(lambda race: np.min(
-                        self.haversine(self.shorelines.lat,
-                                       self.shorelines.lon,
-                                       race['lat'],
-                                       race['lon']
-                                       ) / 1000  # in km
-                            ))
-            )
+            distance_to_nearest_shoreline=shorelines.query(X['lat'], X['lon']) / 1000  # in km
         )
 
 
@@ -701,51 +814,33 @@ class DistanceToNearestAirport(BaseEstimator, TransformerMixin):
     """
     Compute distance to neareast airport (+ international airport)
     """
-
-    airports = Airports().load()
-
-    @staticmethod
-    def haversine(lat1, lon1, lat2, lon2):
-        """
-        Calculate distance (in meters) between two lat/lon pairs
-        """
-        lat1_rad = np.radians(lat1)
-        lat2_rad = np.radians(lat2)
-        lon1_rad = np.radians(lon1)
-        lon2_rad = np.radians(lon2)
-        delta_lat = lat2_rad - lat1_rad
-        delta_lon = lon2_rad - lon1_rad
-        a = np.sqrt((np.sin(delta_lat / 2)) ** 2 + np.cos(lat1_rad) * np.cos(lat2_rad) * (np.sin(delta_lon / 2)) ** 2)
-        d = 2 * 6371000 * np.arcsin(a)
-        return d
+    # columns used/added (see StageRunner)
+    requires = ['lat', 'lon']
+    provides = [
+        'distance_to_nearest_airport',
+        'distance_to_nearest_airport_international'
+    ]
+    sources = [Airports]
 
     def fit(self, X, y=None):
         return self
 
+    @staticmethod
+    def international(airports):
+        return airports.loc[airports.name.str.lower().str.contains("international")]
+
     def transform(self, X):
-        international_airports = self.airports.loc[
-            self.airports.name.str.lower().str.contains("international")
-        ]
+        airports = GeoIndex.load(Airports.url, 'airports',
+                                 lambda: Airports().load())
+        international_airports = GeoIndex.load(
+            Airports.url, 'international',
+            lambda: self.international(Airports().load()),
+            depends_on=[self.international])
 
-        return pd.concat([
-            X,
-            X[['lat', 'lon']].transpose().apply(lambda race: pd.Series({
-                'distance_to_nearest_airport': np.min(
-                    self.haversine(self.airports.lat,
-                                   self.airports.lon,
-                                   race['lat'],
-                                   race['lon']
-                                   ) / 1000  # in km
-                        ),
-                'distance_to_nearest_airport_international': np.min(
-                    self.haversine(international_airports.lat,
-                                   international_airports.lon,
-                                   race['lat'],
-                                   race['lon']
-                                   ) / 1000  # in km
-                        )
-                })).transpose()
-        ], axis=1)
+        return X.assign(
+            distance_to_nearest_airport=airports.query(X['lat'], X['lon']) / 1000,  # in km
+            distance_to_nearest_airport_international=international_airports.query(X['lat'], X['lon']) / 1000
+        )
 
 
 class GetNearbyFacilities(BaseEstimator, TransformerMixin):
@@ -753,42 +848,59 @@ class GetNearbyFacilities(BaseEstimator, TransformerMixin):
     Get information about nearby attractions, restaurants
     """
 
+    # feature: Foursquare category
+    categories = {
+        'hotels': 'hotels',
+        'restaurants': 'food',
+        'entertainment': 'entertainment',
+        'nightlife': 'nightlife',
+        'shops': 'shops_services',
+        'bike_shops': 'shops_bike',
+        'pools': 'pool',
+        'athletic_centers': 'athletic_centers',
+        'fitness_centers': 'fitness_centers'
+    }
+
+    # columns used/added (see StageRunner)
+    requires = ['race']
+    provides = ['n_metropolitan_cities'] + [f'n_{name}' for name in categories]
+
+    @property
+    def sources(self):
+        return [MetropolitanArea()] + [
+            FoursquarePOIs(category, self.distance)
+            for category in self.categories.values()
+        ]
+
+    def __init__(self, distance=100):
+        # radius (km) of the Foursquare counts
+        self.distance = distance
+
     def fit(self, X, y=None):
         return self
 
     def transform(self, X):
         metropolitanArea = MetropolitanArea().load()
-        hotels = Hotels().load()
-        restaurants = Restaurants().load()
-        entertainment = Entertainment().load()
-        nightLife = Nightlife().load()
-        shops = Shops().load()
-        bikeShops = BikeShops().load()
-        pools = Pools().load()
-        athleticCenters = AthleticCenters().load()
-        fitnessCenters = FitnessCenters().load()
+        facilities = {
+            'n_metropolitan_cities': X['race'].map(
+                lambda race: metropolitanArea[race]['totalCount'])
+        }
+        for name, category in self.categories.items():
+            pois = FoursquarePOIs(category, self.distance).load()
+            facilities[f'n_{name}'] = X['race'].map(
+                lambda race: pois[race]['poi_n_results'])
 
-        return pd.concat([
-            X,
-            X.race.apply(lambda race: pd.Series({
-                'n_metropolitan_cities': metropolitanArea[race]['totalCount'],
-                'n_hotels': hotels[race]['poi_n_results'],
-                'n_restaurants': restaurants[race]['poi_n_results'],
-                'n_entertainment': entertainment[race]['poi_n_results'],
-                'n_nightlife': nightLife[race]['poi_n_results'],
-                'n_shops': shops[race]['poi_n_results'],
-                'n_bike_shops': bikeShops[race]['poi_n_results'],
-                'n_pools': pools[race]['poi_n_results'],
-                'n_athletic_centers': athleticCenters[race]['poi_n_results'],
-                'n_fitness_centers': fitnessCenters[race]['poi_n_results']
-            }))
-        ], axis=1)
+        return X.assign(**facilities)
 
 
 class GetTypicalWeather(BaseEstimator, TransformerMixin):
     """
     Get information about typical weather
     """
+    # columns used/added (see StageRunner)
+    requires = ['race']
+    provides = ['weather_icon', 'weather_summary']
+    sources = [Weather]
 
     def fit(self, X, y=None):
         return self
@@ -802,6 +914,13 @@ class GetTypicalTemperatures(BaseEstimator, TransformerMixin):
     """
     Get information about typical min/max temperatures
     """
+    # columns used/added (see StageRunner)
+    requires = ['race']
+    provides = [
+        'temperatureMin', 'temperatureMax', 'apparentTemperatureMin',
+        'apparentTemperatureMax'
+    ]
+    sources = [Weather]
 
     def fit(self, X, y=None):
         return self
@@ -811,84 +930,163 @@ class GetTypicalTemperatures(BaseEstimator, TransformerMixin):
         return X.merge(weather_temperatures_df, left_on="race", right_on="race", how="left")
 
 
-class RacingTimesStatistics(BaseEstimator, TransformerMixin):
+class RacingTimesStatistics(ResultsMixin, BaseEstimator, TransformerMixin):
     """
     Compute time statistics for races
     """
+    # columns used/added (see StageRunner)
+    requires = ['race']
+    provides = [
+        'swim_min', 'swim_mean', 'swim_max', 'bike_min', 'bike_mean',
+        'bike_max', 'run_min', 'run_mean', 'run_max'
+    ]
+
     def fit(self, X, y=None):
         return self
 
-    def transform(self, X):
-        df_results = ResultsDf(current_races=X['race']).load()
-
-        avg_times = (df_results.loc[((df_results[['swim', 'bike', 'run']] == -1).sum(axis=1) == 0) &
-                                    ((df_results[['swim', 'bike', 'run']] < 0).sum(axis=1) == 0)]
-             .groupby(["race", "year"])[['swim', 'bike', 'run']]
+    def aggregate(self, df_results):
+        # statistics of each edition
+        edition_times = (df_results.loc[((df_results[['swim', 'bike', 'run']] == -1).sum(axis=1) == 0) &
+                                        ((df_results[['swim', 'bike', 'run']] < 0).sum(axis=1) == 0)]
+             .groupby(["race", "year"], observed=True)[['swim', 'bike', 'run']]
              .agg(['min', 'mean', 'max'])
-             .reset_index()
+        )
+        edition_times.columns = ['_'.join(col).strip() for col in edition_times.columns.values]
+        return edition_times.reset_index()
+
+    def aggregate_sql(self, dialect):
+        stats = ', '.join(
+            f"{func}({split}) AS {split}_{name}"
+            for split in ['swim', 'bike', 'run']
+            for func, name in [('MIN', 'min'), ('AVG', 'mean'), ('MAX', 'max')]
+        )
+        return f"""
+            SELECT race, year, {stats}
+            FROM clean
+            WHERE COALESCE(swim, 0) >= 0
+              AND COALESCE(bike, 0) >= 0
+              AND COALESCE(run, 0) >= 0
+            GROUP BY race, year
+        """
+
+    def transform(self, X):
+        # average over the editions
+        avg_times = (self.get_aggregates(X)
+             .drop(columns='year')
              .groupby('race')
-             .mean()[['swim', 'bike', 'run']]
+             .mean()
+             .reset_index()
         )
-        avg_times.columns = ['_'.join(col).strip() for col in avg_times.columns.values]
-        avg_times = avg_times.reset_index()
 
         return X.merge(avg_times, left_on="race", right_on="race", how="left")
 
 
-class RunElevationMap(BaseEstimator, TransformerMixin):
+class ElevationMap(TracksMixin, BaseEstimator, TransformerMixin):
     """
-    Extract and resample elevation profile for the run
+    Extract and resample elevation profile of a discipline
+
+    The profiles of all the races are resampled at once, and kept as
+    (n_races, n_points) float32 arrays in profiles_ (saved next to the races
+    features with write_profiles). With as_json, they are also serialized
+    in the <discipline>_elevation_map column.
     """
+    discipline = None
     n_points = 200
+    # columns used/added (see StageRunner)
+    requires = ['race', 'map']
+
+    def __init__(self, tracks=None, method='fft', as_json=True):
+        super().__init__(tracks=tracks)
+        self.method = method
+        self.as_json = as_json
+
+    @property
+    def provides(self):
+        return [f'{self.discipline}_elevation_map'] if self.as_json else []
+
+    @staticmethod
+    def resample_fft(elevations, n_points):
+        """
+        Fourier resampling of the elevations, tracks with the same number of
+        points are resampled together
+        """
+        resampled = np.empty((len(elevations), n_points))
+        lengths = np.array([len(elevation) for elevation in elevations])
+        for length in np.unique(lengths):
+            rows = np.flatnonzero(lengths == length)
+            resampled[rows] = signal.resample(
+                np.stack([elevations[row] for row in rows]), n_points, axis=1)
+        return resampled
+
+    @staticmethod
+    def resample_linear(distances, elevations, grids):
+        """
+        Linear interpolation of the elevations at the grid distances, follows
+        the actual spacing of the track points
+        """
+        resampled = np.empty(grids.shape)
+        for row, (distance, elevation) in enumerate(zip(distances, elevations)):
+            resampled[row] = np.interp(grids[row], distance, elevation)
+        return resampled
+
+    def resample(self, tracks, races):
+        """
+        Distance grids and resampled elevations of the races, as
+        (n_races, n_points) arrays
+        """
+        races_tracks = [tracks[race][self.discipline] for race in races]
+        distances = [track['distance'] for track in races_tracks]
+        elevations = [track['elevation'] for track in races_tracks]
+        grids = np.linspace(0, [np.max(distance) for distance in distances],
+                            self.n_points, axis=1)
+        if self.method == 'fft':
+            return grids, self.resample_fft(elevations, self.n_points)
+        elif self.method == 'linear':
+            return grids, self.resample_linear(distances, elevations, grids)
+        else:
+            raise ValueError(f"Unknown resampling method: {self.method}")
 
     def fit(self, X, y=None):
         return self
 
     def transform(self, X):
-        return X.assign(
-            run_elevation_map=(
-                X['race']
-                    .map(lambda race:
-                        json.dumps([{"x": x, "y": y} for x, y in zip(
-                            # resample to 500 points
-                            np.linspace(0, np.max(json.loads(X.loc[X['race'] == race, 'map'].values[0])['run']['distance']), self.n_points),
-                          signal.resample(json.loads(X.loc[X['race'] == race, 'map'].values[0])['run']['elevation'], self.n_points)
-                        )])
-
-                    )
-            )
-        )
+        grids, elevations = self.resample(self.get_tracks(X), X['race'])
+        self.profiles_ = {
+            'race': X['race'].to_numpy(dtype=str),
+            f'{self.discipline}_distance': grids.astype(np.float32),
+            f'{self.discipline}_elevation': elevations.astype(np.float32)
+        }
+        if not self.as_json:
+            return X
+        return X.assign(**{
+            f'{self.discipline}_elevation_map': [
+                json.dumps([{"x": x, "y": y} for x, y in zip(grid, elevation)])
+                for grid, elevation in zip(grids.tolist(), elevations.tolist())
+            ]
+        })
 
 
-class BikeElevationMap(BaseEstimator, TransformerMixin):
+class RunElevationMap(ElevationMap):
     """
-    Extract and resample elevation profile for the bike
+    Extract and resample elevation profile for the run
     """
-    n_points = 200
+    discipline = 'run'
 
-    def fit(self, X, y=None):
-        return self
 
-    def transform(self, X):
-        return X.assign(
-            bike_elevation_map=(
-                X['race']
-                    .map(lambda race:
-                        json.dumps([{"x": x, "y": y} for x, y in zip(
-                            # resample to 500 points
-                            np.linspace(0, np.max(json.loads(X.loc[X['race'] == race, 'map'].values[0])['bike']['distance']), self.n_points),
-                          signal.resample(json.loads(X.loc[X['race'] == race, 'map'].values[0])['bike']['elevation'], self.n_points)
-                        )])
-
-                    )
-            )
-        )
+class BikeElevationMap(ElevationMap):
+    """
+    Extract and resample elevation profile for the bike
+    """
+    discipline = 'bike'
 
 
 class IsHalf(BaseEstimator, TransformerMixin):
     """
     Is it a half ironman?
     """
+    # columns used/added (see StageRunner)
+    requires = ['race']
+    provides = ['is_70.3']
 
     def fit(self, X, y=None):
         return self
@@ -908,6 +1106,10 @@ class SelectColumns(BaseEstimator, TransformerMixin):
     def fit(self, X, y=None):
         return self
 
+    # only there if the elevation maps are serialized in the table (they
+    # are in the profiles file otherwise)
+    optional_columns = ['run_elevation_map', 'bike_elevation_map']
+
     def transform(self, X):
         columns_to_keep = [
             'race', 'racename', 'date', 'month', 'imlink', 'city', 'image_url',
@@ -928,4 +1130,8 @@ class SelectColumns(BaseEstimator, TransformerMixin):
              'bike_min', 'bike_mean', 'bike_max', 'run_min', 'run_mean', 'run_max',
             'run_elevation_map', 'bike_elevation_map', 'is_70.3'
         ]
+        columns_to_keep = [
+            col for col in columns_to_keep
+            if col in X.columns or col not in self.optional_columns
+        ]
         return X.loc[:, columns_to_keep]
@@ -1,12 +1,13 @@
 # -*- coding: utf-8 -*-
 import re
-import json
 import scrapy
 
 from scrapy.spidermiddlewares.httperror import HttpError
 from twisted.internet.error import DNSLookupError
 from twisted.internet.error import TimeoutError, TCPTimedOutError
 
+from ..jsonl import iter_jsonl
+
 # use to select only specific races.
 # if no selection, still declare the global variable as it is used for conditional filtering in parse_results.
 race_selection = None
@@ -29,9 +30,7 @@ def get_races_urls(file, selection=None):
     # read file created by racespider
     urls = set()
     races = []
-    with open(file, 'r') as f:
-        data = [json.loads(line.strip()) for line in f.readlines()]
-    for race in data:
+    for race in iter_jsonl(file, ['id', 'website', 'region']):
         if race:
             if selection:
                 if not any(race_id.lower() in race['id'].lower() for race_id in map(lambda x: x['id'], selection)):
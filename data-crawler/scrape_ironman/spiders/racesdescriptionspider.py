@@ -1,12 +1,13 @@
 # -*- coding: utf-8 -*-
 import re
-import json
 import scrapy
 import datetime
 
 from scrapy.spidermiddlewares.httperror import HttpError
 from twisted.internet.error import DNSLookupError
 from twisted.internet.error import TimeoutError, TCPTimedOutError
+
+from ..jsonl import iter_jsonl
   
 # use to select only specific races.
 # if no selection, still declare the global variable as it is used for conditional filtering in parse_results.
@@ -22,9 +23,7 @@ def get_races_urls(fileSources, selection=None):
     urls = set()
     races = []
     for file in fileSources:
-        with open(file, 'r') as f:
-            data = [json.loads(line.strip()) for line in f.readlines()]
-        for race in data:
+        for race in iter_jsonl(file, ['id', 'name', 'location', 'website', 'url', 'region']):
             if race:
                 if selection:
                     if not any(race_id.lower() in race['id'].lower() for race_id in map(lambda x: x['id'], selection)):
@@ -1,9 +1,12 @@
+import os
 import pickle
+import threading
+import numpy as np
 import scipy.sparse
 import pandas as pd
 import json
 
-from .recommenders import ALSRecommender, KNNRecommender
+from .recommenders import ALSRecommender, KNNRecommender, HybridRecommender
 
 models_list = {
     # item-item collaborative filtering using Alternative Least Squares
@@ -26,21 +29,57 @@ models_list = {
         'hash_map': None,
         'load_matrix': None,
         'class': KNNRecommender
+    },
+    # blend of the two above, ranked once
+    'Hybrid': {
+        'name': 'Hybrid ALS + content-based',
+        'components': ['ALS', 'KNN_Content'],
+        'weights': [0.5, 0.5],
+        'class': HybridRecommender
     }
 }
 
 look_up_items = {
     'file': './nostrappdamus/model/data/races_features.csv',
-    'index_col': 'race'
+    'index_col': 'race',
+    # elevation profiles as arrays, written by the ETL next to the features
+    'profiles': './nostrappdamus/model/data/races_features.npz'
 }
 
 # the first time it will be called, the variable will be assigned
 items = None
 items_map = None
+profiles = None
+# models already loaded in memory
+loaded_models = {}
+# models can be requested from several threads at once, load them only once
+# (each under its own lock, so loading one model never blocks the others)
+loading_locks = {}
+loading_locks_lock = threading.Lock()
 
 
 def get_model(model_name):
+    model = loaded_models.get(model_name)
+    if model is not None:
+        return model
+    with loading_locks_lock:
+        lock = loading_locks.setdefault(model_name, threading.Lock())
+    with lock:
+        if model_name not in loaded_models:
+            loaded_models[model_name] = load_model(model_name)
+            print(f"The model {model_name} ({loaded_models[model_name].name})"
+                  " has been loaded")
+    return loaded_models[model_name]
+
+
+def load_model(model_name):
     config = models_list.get(model_name)
+    if config and config.get('components'):
+        # the components are shared with the single models, score caches
+        # included
+        components = [get_model(name) for name in config['components']]
+        return config['class'](components, config['weights'],
+                               items_info=get_items(), name=config['name'])
     if config:
         model_name = config['name']
         model_class = config['class']
@@ -82,7 +121,7 @@ def get_model(model_name):
 
 
 def get_items():
-    global items, items_map
+    global items, items_map, profiles
     if items is not None:
         return items
     else:
@@ -101,21 +140,43 @@ def get_items():
         ]
         items = items_full.loc[:, columns_selection]
         # map info
-        items_map = items_full.loc[:, [
-            'run_elevation_map', 'bike_elevation_map', 'weather_icon',
-            'weather_summary', 'bike_elevationGain', 'run_elevationGain'
-        ]]
-        items_map['run_elevation_map'] = items_map['run_elevation_map'].map(
-            lambda x: json.loads(x)
-        )
-        items_map['bike_elevation_map'] = items_map['bike_elevation_map'].map(
-            lambda x: json.loads(x)
-        )
+        map_columns = [
+            'weather_icon', 'weather_summary', 'bike_elevationGain',
+            'run_elevationGain'
+        ]
+        if os.path.exists(look_up_items['profiles']):
+            profiles = load_profiles(look_up_items['profiles'])
+            items_map = items_full.loc[:, map_columns]
+        else:
+            # older features file, elevation maps serialized as json
+            items_map = items_full.loc[:, [
+                'run_elevation_map', 'bike_elevation_map'] + map_columns]
+            items_map['run_elevation_map'] = items_map['run_elevation_map'].map(
+                lambda x: json.loads(x)
+            )
+            items_map['bike_elevation_map'] = items_map['bike_elevation_map'].map(
+                lambda x: json.loads(x)
+            )
         return items
 
 
+def load_profiles(profiles_file):
+    with np.load(profiles_file) as data:
+        loaded = {key: data[key] for key in data.files}
+    loaded['race'] = pd.Index(loaded['race'])
+    return loaded
+
+
 def get_items_map(raceId='boulder'):
     global items_map
     map_dict = items_map.loc[raceId].to_dict()
+    if profiles is not None:
+        position = profiles['race'].get_loc(raceId)
+        for activity in ['run', 'bike']:
+            map_dict[f'{activity}_elevation_map'] = [
+                {"x": x, "y": y} for x, y in zip(
+                    profiles[f'{activity}_distance'][position].tolist(),
+                    profiles[f'{activity}_elevation'][position].tolist())
+            ]
     map_dict['raceId'] = raceId
     return map_dict
@@ -1,35 +1,133 @@
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+import pandas as pd
+
 from .get_model import get_items, get_model
+from .recommenders import filter_recommendations, options_key
+
+logger = logging.getLogger(__name__)
 
 # Dictionary of possible models
 models = {
     0: 'ALS',
-    1: 'KNN_Content'
+    1: 'KNN_Content',
+    2: 'Hybrid'
 }
 
 items = get_items()
-# will be used to check if we need to load another model in memory
-current_model_number = 0
-current_model = None
+
+# default time (in s) given to a model to answer before falling back
+latency_budget = 2.
+# the recommendations run here, so a request can stop waiting for them
+executor = ThreadPoolExecutor(max_workers=4)
+# last answer for each request, used as fallback
+last_answers = OrderedDict()
+last_answers_size = 1024
+# filled from the executor threads
+last_answers_lock = threading.Lock()
+stats = {
+    'requests': 0,
+    'timeouts': 0
+}
+# updated by the request threads
+stats_lock = threading.Lock()
+# races ordered by popularity, used when nothing else is available
+popular_races = (
+    items.sort_values(['attractivity_score', 'entrants_count_avg'],
+                      ascending=False, na_position='last')
+    .index
+)
+
+
+def load_model(model_number):
+    # models are only loaded once, see get_model
+    return get_model(models[int(model_number)])
 
 
 def get_recommendations(raceId, model_number=0, filterBy=False,
-                        valueToMatch=False, options={}, months_range=[0, 12]):
-    global current_model, current_model_number
+                        valueToMatch=False, options={}, months_range=[0, 12],
+                        aggregate='mean', budget=latency_budget):
+    """
+    raceId can be a single race or a list of races.
 
-    if current_model_number == model_number and\
-       current_model is not None:
-        # model has already been loaded and we use the same
-        return current_model.recommend(
-            raceId, n=10, filterByField=filterBy, valueToMatch=valueToMatch,
-            options=options, months_range=months_range)
-    else:
-        # load new model
-        current_model_number = model_number
-        current_model = get_model(models[int(model_number)])
-        print(
-            f"The model {model_number} ({current_model.name}) has been loaded"
-        )
-        return current_model.recommend(
+    If the model takes more than budget seconds (None to wait as long as
+    needed), the last answer to the same request, or the most popular
+    races, are returned instead, with degraded set to True.
+    """
+    count('requests')
+    key = (
+        (raceId,) if isinstance(raceId, str) else tuple(raceId),
+        int(model_number), filterBy, valueToMatch, options_key(options),
+        tuple(months_range), aggregate
+    )
+
+    def recommend():
+        model = load_model(model_number)
+        recommendations = model.recommend(
             raceId, n=10, filterByField=filterBy, valueToMatch=valueToMatch,
-            options=options, months_range=months_range
+            options=options, months_range=months_range, aggregate=aggregate
         )
+        with last_answers_lock:
+            last_answers[key] = recommendations
+            if len(last_answers) > last_answers_size:
+                last_answers.popitem(last=False)
+        return recommendations
+
+    if budget is None:
+        return recommend().assign(degraded=False)
+
+    future = executor.submit(recommend)
+    try:
+        recommendations = future.result(timeout=budget)
+    except TimeoutError:
+        # not started yet (pool busy with slower requests): dropped, so the
+        # queue does not grow with requests which already fell back.
+        # Otherwise the model keeps running in the background and will fill
+        # the cache for the next time
+        future.cancel()
+        timeouts = count('timeouts')
+        logger.warning(f"Recommendations for {raceId} took more than "
+                       f"{budget}s ({timeouts} timeouts so far)")
+        with last_answers_lock:
+            recommendations = last_answers.get(key)
+        if recommendations is None:
+            recommendations = get_popular_recommendations(
+                raceId, filterBy=filterBy, valueToMatch=valueToMatch,
+                months_range=months_range)
+        return recommendations.assign(degraded=True)
+
+    return recommendations.assign(degraded=False)
+
+
+def count(stat):
+    """
+    Increment a counter of stats, return its new value
+    """
+    with stats_lock:
+        stats[stat] += 1
+        return stats[stat]
+
+
+def get_popular_recommendations(raceId, n=10, filterBy=False,
+                                valueToMatch=False, months_range=[0, 12]):
+    targets = [raceId] if isinstance(raceId, str) else list(raceId)
+    targets = [t for t in targets if t in items.index]
+    races = targets + [r for r in popular_races if r not in targets]
+    df_distances = pd.DataFrame({'race': races, 'similarity': float('nan')})
+    return filter_recommendations(
+        df_distances, items, n=n + len(targets), filterByField=filterBy,
+        valueToMatch=valueToMatch, months_range=months_range,
+        n_targets=len(targets))
+
+
+def get_user_recommendations(races, filterBy=False, valueToMatch=False,
+                             months_range=[0, 12]):
+    # only the ALS model knows about athletes
+    model = load_model(0)
+    return model.recommend_for_user(
+        races, n=10, filterByField=filterBy, valueToMatch=valueToMatch,
+        months_range=months_range
+    )
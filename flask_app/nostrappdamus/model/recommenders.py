@@ -1,12 +1,28 @@
+import threading
+from collections import OrderedDict
+
 import numpy as np
 import pandas as pd
 from sklearn.neighbors import NearestNeighbors
 
+try:
+    import numba
+except ImportError:
+    numba = None
+
 
 class BaseRecommender:
+    # do the scores depend on the options (raceExperience, ...)?
+    uses_options = False
+    # number of score vectors kept in memory
+    cache_size = 256
+
     def __init__(self, model, matrix=None, items_info=None,
                  pos_to_item_mapping=None, df=None, name='Model'):
         self.name = name
+        self._scores_cache = OrderedDict()
+        # the recommendations run in several threads (see predict)
+        self._cache_lock = threading.Lock()
         self.model = model
         if self.model is None:
             # Default model is Nearest Neighbors
@@ -21,73 +37,193 @@ class BaseRecommender:
             self.items_info = items_info.loc[df.index]
         self.items_info_reset = self.items_info.reset_index()
 
+    def get_codes(self, targets):
+        """
+        Positions of the target race(s) in items_info. A single race or a
+        list of races can be given.
+        """
+        if isinstance(targets, str):
+            targets = [targets]
+        codes = self.items_info.index.get_indexer(targets)
+        if (codes < 0).any():
+            raise KeyError(
+                [t for t, c in zip(targets, codes) if c < 0])
+        return codes
+
+    def similarities(self, codes, options={}):
+        """
+        Similarity of each target (rows) to every item (columns).
+        """
+        raise NotImplementedError
+
+    def scores(self, targets, options={}, aggregate='mean'):
+        """
+        Aggregated score of every item for the target(s), cached.
+        """
+        key = (
+            (targets,) if isinstance(targets, str) else tuple(targets),
+            aggregate,
+            options_key(options) if self.uses_options else None
+        )
+        with self._cache_lock:
+            scores = self._scores_cache.get(key)
+            if scores is not None:
+                self._scores_cache.move_to_end(key)
+                return scores
+
+        # computed outside of the lock, the other queries don't wait
+        scores = self.compute_scores(targets, dict(options), aggregate)
+        # shared between requests, must not be modified
+        scores.setflags(write=False)
+        with self._cache_lock:
+            self._scores_cache[key] = scores
+            if len(self._scores_cache) > self.cache_size:
+                self._scores_cache.popitem(last=False)
+        return scores
+
+    def compute_scores(self, targets, options={}, aggregate='mean'):
+        codes = self.get_codes(targets)
+        return aggregate_similarities(
+            self.similarities(codes, options), how=aggregate)
+
+    def recommend(self, target, n=10, filterByField=False,
+                  valueToMatch=False, months_range=[0, 12], options={},
+                  aggregate='mean'):
+        codes = self.get_codes(target)
+        scores = self.scores(target, options=options, aggregate=aggregate)
+        return self.rank(scores, codes, n=n, filterByField=filterByField,
+                         valueToMatch=valueToMatch, months_range=months_range)
+
+    def rank(self, scores, codes, n=10, filterByField=False,
+             valueToMatch=False, months_range=[0, 12]):
+        """
+        Order the items by decreasing score, with the target race(s) on top.
+        """
+        order = np.argsort(-scores, kind='stable')
+        is_target = np.zeros(len(scores), dtype=bool)
+        is_target[codes] = True
+        order = np.concatenate([codes, order[~is_target[order]]])
+
+        df_distances = pd.DataFrame({
+            'race': self.items_info.index.values[order],
+            'similarity': scores[order]
+        })
+        return self.filter_recommendations(
+            df_distances, n=n + len(codes), filterByField=filterByField,
+            valueToMatch=valueToMatch, months_range=months_range,
+            n_targets=len(codes))
+
+    def filter_recommendations(self, df_distances, n=10, filterByField=False,
+                               valueToMatch=False, months_range=[0, 12],
+                               n_targets=1):
+        return filter_recommendations(
+            df_distances, self.items_info, n=n, filterByField=filterByField,
+            valueToMatch=valueToMatch, months_range=months_range,
+            n_targets=n_targets)
+
 
 class ALSRecommender(BaseRecommender):
     '''Alternative Least Square models from the implicit library'''
 
-    def recommend(self, target, n=10, filterByField=False,
-                  valueToMatch=False, months_range=[0, 12], options={}):
-        target_code = self.items_info.index.get_loc(target)
-        similar = self.model.similar_items(target_code, len(self.items_info))
+    def __init__(self, model, **kwargs):
+        super().__init__(model, **kwargs)
+        # resident copy of the item factors, so queries never touch the
+        # implicit model itself
+        self.item_factors = np.ascontiguousarray(model.item_factors,
+                                                 dtype=np.float64)
+        # normalized factors, for cosine similarities between items
+        norms = np.linalg.norm(self.item_factors, axis=1)
+        norms[norms == 0] = 1e-10
+        self.item_factors_normed = self.item_factors / norms[:, np.newaxis]
+        n_factors = self.item_factors.shape[1]
+        # YtY + regularization * I is shared by every fold-in
+        self.YtY_reg = (self.item_factors.T.dot(self.item_factors) +
+                        model.regularization * np.eye(n_factors))
+        # confidence given to a race in the athlete history, taken from the
+        # training matrix so a folded-in user looks like a trained one
+        self.confidence = 1.
+        if self.matrix is not None and self.matrix.nnz:
+            self.confidence = float(self.matrix.data.mean())
 
-        df_distances = pd.DataFrame([
-            [self.items_info_reset.loc[code, 'race'], distance]
-            for (code, distance) in similar
-        ], columns=['race', 'similarity'])
+    def similarities(self, codes, options={}):
+        # same cosine similarity as implicit's similar_items, for all the
+        # targets at once
+        return self.item_factors_normed[codes].dot(
+            self.item_factors_normed.T)
 
-        df_order = df_distances.merge(self.items_info, left_on='race',
-                                      right_on='race', how='left')
-        if filterByField:
-            if df_order.loc[0, filterByField] != valueToMatch:
-                # ensure the initial target race will be present
-                # even if it doesn't fit the filter
-                df_order.loc[0, filterByField] = valueToMatch
-            df_order = df_order.loc[df_order[filterByField] == valueToMatch]
+    def user_factors(self, races):
+        """
+        Fold in an athlete from the list of races they have done (a race can
+        appear several times), solving the ALS user least squares against
+        the cached YtY.
+        """
+        codes = self.items_info.index.get_indexer(races)
+        codes, counts = np.unique(codes[codes >= 0], return_counts=True)
+        if not len(codes):
+            return None
+        Y = self.item_factors[codes]
+        confidence = counts * self.confidence
+        # A = YtY + reg * I + Yt (Cu - I) Y, b = Yt Cu Pu
+        A = self.YtY_reg + (Y.T * (confidence - 1)).dot(Y)
+        b = confidence.dot(Y)
+        return np.linalg.solve(A, b)
 
-        # filter by months into months range
-        df_order = df_order.loc[(df_order['month'] > months_range[0]) &
-                                (df_order['month'] <= months_range[1])]
+    def recommend_for_user(self, races, n=10, filterByField=False,
+                           valueToMatch=False, months_range=[0, 12]):
+        user = self.user_factors(races)
+        if user is None:
+            return self.items_info.iloc[:0].reset_index()
+        scores = self.item_factors.dot(user)
 
-        return df_order.iloc[:n + 1]
+        # races already done are not worth recommending
+        done = self.items_info.index.isin(races)
+        order = np.argsort(-scores, kind='stable')
+        order = order[~done[order]]
+
+        df_distances = pd.DataFrame({
+            'race': self.items_info.index.values[order],
+            'similarity': scores[order]
+        })
+        return self.filter_recommendations(
+            df_distances, n=n, filterByField=filterByField,
+            valueToMatch=valueToMatch, months_range=months_range,
+            n_targets=0)
 
 
 class KNNRecommender(BaseRecommender):
     '''K-Nearest Neighbors from the scikit-learn library'''
 
-    def recommend(self, target, n=10, filterByField=False,
-                  valueToMatch=False, months_range=[0, 12], options={}):
+    uses_options = True
 
-        # get weighted features and refit the model
-        df = self.getTransformedMatrix(target, options)
-        self.model.fit(df.values)
+    def __init__(self, model, **kwargs):
+        super().__init__(model, **kwargs)
+        self.features = np.ascontiguousarray(self.df.values, dtype=np.float64)
+        # the model is refitted for each query, on the weighted features
+        # written in a buffer shared by the queries
+        self._lock = threading.Lock()
+        self._weighted = np.empty_like(self.features)
 
-        # do predictions
-        (distances, indices) = self.model.kneighbors(
-            df.loc[target].values.reshape(1, -1),
-            n_neighbors=len(self.items_info)
-        )
-        df_distances = pd.concat([
-            pd.Series(self.items_info_reset.loc[indices[0], 'race'].values,
-                      name='race'),
-            pd.Series(distances[0], name='similarity')
-        ], axis=1)
-
-        df_order = df_distances.merge(self.items_info, left_on='race',
-                                      right_on='race', how='left')
-        if filterByField:
-            if df_order.loc[0, filterByField] != valueToMatch:
-                # ensure the initial target race will be present
-                # even if it doesn't fit the filter
-                df_order.loc[0, filterByField] = valueToMatch
-            df_order = df_order.loc[df_order[filterByField] == valueToMatch]
-
-        # filter by months into months range
-        df_order = df_order.loc[(df_order['month'] > months_range[0]) &
-                                (df_order['month'] <= months_range[1])]
-
-        return df_order.iloc[:n + 1]
-
-    def getTransformedMatrix(self, target, options):
+    def similarities(self, codes, options={}):
+        with self._lock:
+            # get weighted features and refit the model
+            weighted = self.getTransformedMatrix(
+                self.df.index[codes], options, out=self._weighted)
+            self.model.fit(weighted)
+
+            # do predictions for all the targets in one call
+            (distances, indices) = self.model.kneighbors(
+                weighted[codes], n_neighbors=len(self.items_info)
+            )
+        # back to item order, as cosine similarity
+        similarities = np.empty_like(distances)
+        np.put_along_axis(similarities, indices, 1 - distances, axis=1)
+        return similarities
+
+    def getTransformedMatrix(self, target, options, out=None):
+        """
+        Features weighted by the options, in the order of df, written into
+        out if given.
+        """
         options['raceExperience'] = float(options['raceExperience'])
         options['raceSize'] = float(options['raceSize'])
         options['raceDifficulty'] = float(options['raceDifficulty'])
@@ -152,17 +288,134 @@ class KNNRecommender(BaseRecommender):
             'increase': True
         }
 
-        data_transformed = self.df.copy()
+        columns = list(to_transform.keys())
+        weighted = weight_matrix(
+            self.features,
+            [self.df.columns.get_loc(col) for col in columns],
+            [to_transform[col]['dial'] for col in columns],
+            [to_transform[col]['increase'] for col in columns],
+            out=out)
+
+        # the query race(s) get the weights the user asked for
+        target_rows = self.df.index.get_indexer(
+            [target] if isinstance(target, str) else target)
+        for col in columns:
+            weighted[target_rows, self.df.columns.get_loc(col)] = \
+                transform_query(to_transform[col]['dial_query'])
+
+        return weighted
+
+
+class HybridRecommender(BaseRecommender):
+    '''Weighted blend of the scores of several recommenders'''
+
+    uses_options = True
+
+    def __init__(self, components, weights, items_info=None, name='Model'):
+        self.name = name
+        self._scores_cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+        self.components = components
+        self.weights = weights
+        # all the races known by at least one of the models
+        races = components[0].items_info.index
+        for component in components[1:]:
+            races = races.append(
+                component.items_info.index.difference(races, sort=False))
+        self.items_info = items_info.loc[races]
+        self.items_info_reset = self.items_info.reset_index()
+        # where the items of each model go in the blended score vector
+        self.positions = [races.get_indexer(component.items_info.index)
+                          for component in components]
+
+    def compute_scores(self, targets, options={}, aggregate='mean'):
+        targets = [targets] if isinstance(targets, str) else list(targets)
+        self.get_codes(targets)
+        weights = options.pop('weights', None) or self.weights
 
-        for col in to_transform.keys():
-            data_transformed[col] = transform_col(
-                data_transformed, col, to_transform[col]['dial'],
-                increase=to_transform[col]['increase'])
-            data_transformed.loc[target, col] = transform_query(
-                to_transform[col]['dial_query'])
+        blended = np.zeros(len(self.items_info))
+        # weight of the models scoring each race
+        total_weight = np.zeros(len(self.items_info))
+        for component, positions, weight in zip(self.components,
+                                                self.positions, weights):
+            # a target unknown to one model is only scored by the others
+            known = [t for t in targets if t in component.items_info.index]
+            if not known or not weight:
+                continue
+            # the raw scores of the models are on different scales
+            blended[positions] += weight * minmax_scale(component.scores(
+                known, options=options, aggregate=aggregate))
+            total_weight[positions] += weight
+        # a race unknown to one model is only scored by the others, the
+        # races no model scores stay at 0, the lowest score
+        scored = total_weight > 0
+        blended[scored] /= total_weight[scored]
+        return blended
 
-        # return self.df
-        return data_transformed
+
+def filter_recommendations(df_distances, items_info, n=10,
+                           filterByField=False, valueToMatch=False,
+                           months_range=[0, 12], n_targets=1):
+    """
+    Add the races info to the ordered races and keep the n first ones
+    matching the filters. The n_targets first races are always kept.
+    """
+    df_order = df_distances.merge(items_info, left_on='race',
+                                  right_on='race', how='left')
+    if filterByField and n_targets:
+        # ensure the initial target races will be present
+        # even if they don't fit the filter
+        df_order.loc[:n_targets - 1, filterByField] = valueToMatch
+    if filterByField:
+        df_order = df_order.loc[df_order[filterByField] == valueToMatch]
+
+    # filter by months into months range
+    df_order = df_order.loc[(df_order['month'] > months_range[0]) &
+                            (df_order['month'] <= months_range[1])]
+
+    return df_order.iloc[:n]
+
+
+def options_key(options):
+    """
+    Hashable version of the options ('3' and 3 give the same key).
+    """
+    key = []
+    for option, value in sorted(options.items()):
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            value = repr(value)
+        key.append((option, value))
+    return tuple(key)
+
+
+def aggregate_similarities(similarities, how='mean', k=60):
+    """
+    Combine the similarity vectors of several targets into one score.
+
+    how is 'mean', 'max' or 'rrf' (reciprocal rank fusion, with constant k).
+    """
+    similarities = np.atleast_2d(similarities)
+    if how == 'mean':
+        return similarities.mean(axis=0)
+    elif how == 'max':
+        return similarities.max(axis=0)
+    elif how == 'rrf':
+        ranks = np.argsort(np.argsort(-similarities, axis=1), axis=1)
+        return (1. / (k + 1 + ranks)).sum(axis=0)
+    else:
+        raise ValueError(f"Unknown aggregation: {how}")
+
+
+def minmax_scale(scores):
+    """
+    Scores rescaled to [0, 1] (all 0 if they are all equal).
+    """
+    low, high = scores.min(), scores.max()
+    if high == low:
+        return np.zeros(len(scores))
+    return (scores - low) / (high - low)
 
 
 ########################
@@ -180,11 +433,50 @@ def transform_query(dial):
     return dial * sigmo_transform(dial, 0, 1, 3, 2.1)
 
 
-def transform_col(df, column, dial, increase=True):
-    factor = dial  # slope of sigmoid
-    if increase:
-        return dial * sigmo_transform(
-            df[column].values, 0, 1, 0.5, factor)[:, np.newaxis]
-    else:
-        return dial * (1 - sigmo_transform(
-            df[column].values, 0, 1, 0.5, factor))[:, np.newaxis]
+def _weight_columns_numpy(base, columns, dials, increase, out):
+    # increase=False is the mirrored sigmoid: 1 - s(x) == s(-x)
+    for col, dial, inc in zip(columns, dials, increase):
+        # basic slice, the column is computed in place in out
+        view = out[:, col]
+        np.subtract(base[:, col], 0.5, out=view)
+        np.multiply(view, -dial if inc else dial, out=view)
+        np.exp(view, out=view)
+        np.add(view, 1., out=view)
+        np.divide(dial, view, out=view)
+    return out
+
+
+def _weight_columns_loop(base, columns, dials, increase, out):
+    for j in range(columns.shape[0]):
+        col = columns[j]
+        dial = dials[j]
+        slope = -dial if increase[j] else dial
+        for i in range(base.shape[0]):
+            out[i, col] = dial / (1. + np.exp(slope * (base[i, col] - 0.5)))
+    return out
+
+
+if numba is not None:
+    _weight_columns = numba.njit(cache=True)(_weight_columns_loop)
+else:
+    _weight_columns = _weight_columns_numpy
+
+
+def weight_matrix(base, columns, dials, increase, out=None):
+    """
+    Weight several columns of base at once with the sigmoid of their dial:
+    dial * s(x), or dial * (1 - s(x)) if not increase.
+
+    Columns not listed are copied untouched. The result is written into
+    out (allocated if None), which may be reused across calls.
+    """
+    base = np.ascontiguousarray(base, dtype=np.float64)
+    if out is None:
+        out = np.empty_like(base)
+    out[:] = base
+    columns = np.asarray(columns, dtype=np.int64)
+    dials = np.asarray(dials, dtype=np.float64)
+    increase = np.asarray(increase, dtype=np.bool_)
+    if len(columns) == 0:
+        return out
+    return _weight_columns(base, columns, dials, increase, out)
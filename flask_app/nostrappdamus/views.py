@@ -1,14 +1,17 @@
 from flask import render_template, jsonify, request
 import json
 
-from .model.predict import get_recommendations
+from .model.predict import get_recommendations, get_user_recommendations
 from .model.get_model import get_items, get_items_map
 from nostrappdamus import app
 
 import logging
 
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
+# the handler goes on the logger of the package, so the model modules log
+# to the same file
+app_logger = logging.getLogger('nostrappdamus')
+app_logger.setLevel(logging.INFO)
 
 # create a file handler
 handler = logging.FileHandler('activity.log')
@@ -20,7 +23,7 @@ formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
 handler.setFormatter(formatter)
 
 # add the handlers to the logger
-logger.addHandler(handler)
+app_logger.addHandler(handler)
 
 
 @app.route('/')
@@ -48,23 +51,71 @@ def get_recommendation():
     logger.info(f"({IP}) -- [{args.get('model')}, {args.get('race')}, {args.get('filterBy')}, {args.get('months_range')}, {options.get('raceExperience')}, {options.get('raceDifficulty')}, {options.get('raceSize')}]")
 
     # process request
+    # race can be a single race or a list of races
     race = args.get('race')
     filterBy = args.get('filterBy')
     model = args.get('model')
     months_range = args.get('months_range')
+    # how to combine several races: mean, max or rrf
+    aggregate = args.get('aggregate') or 'mean'
 
     if race:
         if filterBy == 'all':
             # recommendations = get_most_similar_races_to(race)
-            recommendations = get_recommendations(race, model_number=model, options=options, months_range=months_range)
+            recommendations = get_recommendations(race, model_number=model, options=options, months_range=months_range,
+                                                  aggregate=aggregate)
         elif filterBy == '70.3':
             # recommendations = get_most_similar_races_to(race, filterBy='is_70.3', valueToMatch=True)
             recommendations = get_recommendations(race, model_number=model, filterBy='is_70.3', valueToMatch=True, 
-                                                  options=options, months_range=months_range)
+                                                  options=options, months_range=months_range, aggregate=aggregate)
         else:
             # recommendations = get_most_similar_races_to(race, filterBy='is_70.3', valueToMatch=False)
             recommendations = get_recommendations(race, model_number=model, filterBy='is_70.3', valueToMatch=False, 
-                                                  options=options, months_range=months_range)
+                                                  options=options, months_range=months_range, aggregate=aggregate)
+
+        # degraded: fallback answer, the model was too slow
+        degraded = bool(recommendations['degraded'].any())
+        if degraded:
+            logger.warning(f"({IP}) -- degraded answer for {race}")
+        results = recommendations.to_json(orient='records')
+
+        response = jsonify({ 
+          'message': 'Data received.',
+          'data': json.loads(results),
+          'degraded': degraded
+        }), 200
+    else:
+        response = jsonify({ 
+          'message': 'Data received.',
+          'data': [],
+          'degraded': False
+        }), 200
+
+    return response
+
+
+@app.route('/recommend/history', methods=['POST'])
+def get_user_recommendation():
+
+    args = request.json
+    # list of races the athlete has already done
+    races = args.get('races') or []
+    filterBy = args.get('filterBy')
+    months_range = args.get('months_range') or [0, 12]
+
+    # write to log
+    IP = request.environ.get('HTTP_X_REAL_IP', request.remote_addr) 
+    logger.info(f"({IP}) -- history [{races}, {filterBy}, {months_range}]")
+
+    if races:
+        if filterBy == 'all':
+            recommendations = get_user_recommendations(races, months_range=months_range)
+        elif filterBy == '70.3':
+            recommendations = get_user_recommendations(races, filterBy='is_70.3', valueToMatch=True,
+                                                       months_range=months_range)
+        else:
+            recommendations = get_user_recommendations(races, filterBy='is_70.3', valueToMatch=False,
+                                                       months_range=months_range)
 
         results = recommendations.to_json(orient='records')
 
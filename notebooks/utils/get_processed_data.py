@@ -1,43 +1,67 @@
+import os
+import sys
 import pandas as pd
-import mysql.connector
 
-from config import Cfg as cfg
+# db access and results typing shared with the ETL (db_backend = 'sqlite'
+# and db_path in config to work on a local snapshot)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'ETL-pipeline'))
+from db import get_database, MAX_PARAMS
+from load_ext import type_results, concat_chunks
 
 
-def get_results_df(df_races=None, anonimize=True):
-  cnx = mysql.connector.connect(user=cfg.mysql_user, database=cfg.mysql_db, password=cfg.mysql_pw, ssl_disabled=True)
+def clean_results_chunk(chunk, races=None, min_year=2015):
+  # worldchampionship70.3 and worldchampionship70.3m are the same race
+  chunk.loc[chunk.race == "worldchampionship70.3m", 'race'] = 'worldchampionship70.3'
 
-  query = "SELECT * FROM results;"
+  if races is not None:
+      # keep only results of non discontinued races
+      chunk = chunk[chunk['race'].isin(races)]
 
-  # execute the query and assign it to a pandas dataframe
-  df_results = pd.read_sql(query, con=cnx)
+  # remove world championship races since we cannot really recommend it
+  chunk = chunk[~chunk['race'].str.contains('worldchampionship')]
 
-  cnx.close()
+  # str to int, and keep only results from after min_year
+  chunk = chunk.assign(year=pd.to_numeric(chunk['year']).astype('int16'))
+  chunk = chunk.loc[chunk['year'] >= min_year]
 
-  print("Number of single results:", len(df_results))
-  print("Number of individuals:", len(df_results.athlete.unique()))
+  # compact types: categories for repeated strings, times in seconds
+  return type_results(chunk)
 
-  # worldchampionship70.3 and worldchampionship70.3m are the same race
-  df_results.loc[df_results.race == "worldchampionship70.3m", 'race'] = 'worldchampionship70.3'
 
-  if type(df_races) != type(None):
-      # keep only results of non discontinued races
-      df_results = df_results[df_results['race'].isin(df_races.index)]
+def read_results(races=None, min_year=2015, columns=None, chunksize=100000):
+  """
+  Stream the results table by chunks, filtering and typing each chunk
+  so the full untyped table is never in memory
+  """
+  db = get_database()
+  # filters of clean_results_chunk run by the db, only the needed results
+  # are fetched
+  contains = db.dialect['contains'].format(col='race', sub='worldchampionship')
+  where = [
+      (f"CAST(year AS {db.dialect['integer']}) >= {{}}", min_year),
+      (f"NOT ({contains})",)
+  ]
+  filters = {'race': list(races)} if races is not None and len(races) <= MAX_PARAMS else None
+  query, params = db.select('results', columns, where=where, filters=filters)
 
-  # remove world championship races since we cannot really recommend it
-  df_results = df_results[~df_results['race'].str.contains('worldchampionship')]
+  n_results = 0
+  chunks = []
+  for chunk in db.read_chunks(query, params, chunksize=chunksize):
+      n_results += len(chunk)
+      chunks.append(clean_results_chunk(chunk, races=races, min_year=min_year))
 
-  # extract gender from division
-  df_results['gender'] = df_results['division'].apply(lambda x: x[0])
+  print("Number of single results:", n_results)
+
+  # same categories in all the chunks so they stay categorical
+  return concat_chunks(chunks, columns=columns)
 
-  # convert date to datetime
-  df_results['date'] = pd.to_datetime(df_results['date'])
 
-  # str to int
-  df_results['year'] = df_results['year'].apply(int)
+def get_results_df(df_races=None, anonimize=True, columns=None):
+  races = df_races.index if type(df_races) != type(None) else None
+  df_results = read_results(races=races, min_year=2015, columns=columns)
 
-  # keep only results from after 2015
-  df_results = df_results.loc[df_results['year'] >= 2015]
+  # extract gender from division
+  df_results['gender'] = df_results['division'].apply(lambda x: x[0])
 
   # # discard pro athletes
   # df_results = df_results.loc[df_results.division.str.contains("PRO") == False]
@@ -73,7 +97,7 @@ def get_athletes_races_count(df_results):
 
     # total number of different races per athlete
     athletes_count_diff_races = (df_results
-         .groupby(['athlete', 'race'])
+         .groupby(['athlete', 'race'], observed=True)
          .size()
          .reset_index()
          .groupby('athlete')